@@ -34,15 +34,35 @@ import socket
 import threading
 import psutil
 import shutil
-import pathlib
-
-duetLapse3Version = '3.5.0'
-
+import zipfile
+import concurrent.futures
+import contextlib
+import tempfile
+import math
+import bisect
+import fnmatch
+import ctypes
+import ctypes.util
+import struct
+import email.utils
+
+duetLapse3Version = '3.6.0'
+
+
+# Encode profiles: speed is relative to balanced
+encodeprofiles = {'fast-preview': {'preset': 'veryfast', 'crf': '28', 'pixfmt': 'yuv420p', 'speed': 4.0},
+                  'balanced': {'preset': 'medium', 'crf': '23', 'pixfmt': 'yuv420p', 'speed': 1.0},
+                  'archive': {'preset': 'slow', 'crf': '18', 'pixfmt': 'yuv420p', 'speed': 0.5}
+                  }
+balancedrate = 1500000  # approximate pixels per second per core for balanced on a Raspberry Pi 4
 
 def setstartvalues():
     global zo1, zo2, printState, capturing, duetStatus, timePriorPhoto1, timePriorPhoto2, frame1, frame2
+    global segments, segmentfps, segmentrun, session, manifest, archive, zposition, zrefresh
     zo1 = -1  # Starting layer for Camera1
     zo2 = -1  # Starting layer for Camera2
+    zposition = -1  # Last known head height - recorded with each frame
+    zrefresh = None  # Thread fetching the head height
     printState = 'Not Capturing'
     capturing = False
     duetStatus = 'Not yet determined'
@@ -55,6 +75,18 @@ def setstartvalues():
     frame1 = 0
     frame2 = 0
 
+    # frames of the capture set are recorded when the working directory is created
+    manifest = None
+    archive = None
+
+    # each capture set is a new session of the job
+    session = str(os.getpid()) + '-' + str(int(time.time()))
+
+    # reset the video segments - the frames they were made from are about to be deleted
+    segments = {'Camera1': [], 'Camera2': []}
+    segmentfps = ''
+    segmentrun = time.time_ns()  # a segment of an earlier run (e.g. before a restart) is never used
+
 
 ###########################
 # Methods begin here
@@ -100,6 +132,23 @@ def whitelist(parser):
     parser.add_argument('-maxffmpeg', type=int, nargs=1, default=[2],
                         help='Max instances of ffmpeg during video creation. Default = 2')
     parser.add_argument('-keepfiles', action='store_true', help='Dont delete files on startup or shutdown')
+    parser.add_argument('-resume', action='store_true', help='Continue the images of an instance that stopped unexpectedly')
+    parser.add_argument('-quota', type=int, nargs=1, default=[0],
+                        help='Maximum MB used by this printer\'s files. Default = 0 (no limit)')
+    parser.add_argument('-minfree', type=int, nargs=1, default=[0],
+                        help='Minimum MB of free disk space. Default = 0 (no limit)')
+    parser.add_argument('-stage', type=str, nargs=1, default=[''],
+                        help='Directory (e.g. tmpfs) where images are held before being written in batches. Default = none')
+    parser.add_argument('-stagesize', type=int, nargs=1, default=[32],
+                        help='Maximum MB of images held in -stage. Default = 32')
+    parser.add_argument('-ingestwidth', type=int, nargs=1, default=[0],
+                        help='Images wider than this are resized as they are captured. Default = 0 (not resized)')
+    parser.add_argument('-ingestquality', type=int, nargs=1, default=[3],
+                        help='jpeg quality of resized images from 2 (best) to 31. Default = 3')
+    parser.add_argument('-ingestworkers', type=int, nargs=1, default=[1],
+                        help='Number of images resized at the same time. Default = 1')
+    parser.add_argument('-keeporiginal', action='store_true', help='Keeps the original of resized images.')
+    parser.add_argument('-livezip', action='store_true', help='Adds each image to a zip file as it is captured.')
     # Execution
     parser.add_argument('-dontwait', action='store_true', help='Capture images immediately.')
     parser.add_argument('-seconds', type=float, nargs=1, default=[0])
@@ -121,6 +170,8 @@ def whitelist(parser):
     parser.add_argument('-weburl2', type=str, nargs=1, default=[''], help='Url for Camera2 if web or stream')
     # Video
     parser.add_argument('-extratime', type=float, nargs=1, default=[0], help='Time to repeat last image, Default = 0')
+    parser.add_argument('-segment', type=int, nargs=1, default=[0],
+                        help='Frames per background video segment. Default = 0 (no segments)')
     # Overrides
     parser.add_argument('-camparam1', type=str, nargs=1, default=[''],
                         help='Camera1 Capture overrides. Use -camparam1="parameters"')
@@ -131,6 +182,22 @@ def whitelist(parser):
     parser.add_argument('-vidparam2', type=str, nargs=1, default=[''],
                         help='Camera2 Video overrides. Use -vidparam2="parameters"')
     parser.add_argument('-fps', type=int, nargs=1, default=[10], help='Frames-per-second for video. Default = 10')
+    parser.add_argument('-profile', type=str, nargs=1, choices=['auto', 'fast-preview', 'balanced', 'archive'],
+                        default=['balanced'], help='Video encode profile. Default = balanced')
+    parser.add_argument('-encodetime', type=int, nargs=1, default=[300],
+                        help='Target encode time in seconds for -profile auto. Default = 300')
+    parser.add_argument('-composite', type=str, nargs=1, choices=['none', 'hstack', 'vstack', 'pip'], default=['none'],
+                        help='Make one video with both cameras. Default = none')
+    parser.add_argument('-compositematch', type=str, nargs=1, choices=['index', 'time'], default=['index'],
+                        help='Pair Camera1 and Camera2 frames by index or capture time. Default = index')
+    parser.add_argument('-decimate', type=float, nargs=1, default=[0],
+                        help='Minutes of frames kept in full - older frames are progressively thinned. Default = 0 (off)')
+    parser.add_argument('-maxframes', type=int, nargs=1, default=[0],
+                        help='Maximum frames in a video - extra frames are thinned out. Default = 0 (no limit)')
+    parser.add_argument('-vidlength', type=float, nargs=1, default=[0],
+                        help='Maximum video length in seconds - extra frames are thinned out. Default = 0 (no limit)')
+    parser.add_argument('-proxy', type=int, nargs=1, default=[0],
+                        help='Height of a preview video made with each video. Default = 0 (no preview)')
     parser.add_argument('-hidebuttons', action='store_true', help='Hides buttons not logically available.')
     return parser
 
@@ -165,7 +232,8 @@ def init():
 
     # Environment
     global duet, basedir, poll, instances, logtype, nolog, verbose, host, port
-    global keeplogs, novideo, deletepics, maxffmpeg, keepfiles
+    global keeplogs, novideo, deletepics, maxffmpeg, keepfiles, resume, quota, minfree, stage, stagesize
+    global ingestwidth, ingestquality, ingestworkers, keeporiginal, livezip
     # Derived  globals
     global duetname, debug, ffmpegquiet, httpListener
     duet = args['duet'][0]
@@ -182,6 +250,16 @@ def init():
     deletepics = args['deletepics']
     maxffmpeg = args['maxffmpeg'][0]
     keepfiles = args['keepfiles']
+    resume = args['resume']
+    quota = args['quota'][0]
+    minfree = args['minfree'][0]
+    stage = args['stage'][0]
+    stagesize = args['stagesize'][0]
+    ingestwidth = args['ingestwidth'][0]
+    ingestquality = min(31, max(2, args['ingestquality'][0]))
+    ingestworkers = max(1, args['ingestworkers'][0])
+    keeporiginal = args['keeporiginal']
+    livezip = args['livezip']
 
     # Execution
     global dontwait, seconds, detect, pause, movehead, rest, standby
@@ -202,9 +280,19 @@ def init():
     weburl2 = args['weburl2'][0]
 
     # Video
-    global extratime, fps
+    global extratime, fps, segment, profile, encodetime, proxy, maxframes, vidlength, decimate
+    global composite, compositematch
     extratime = str(args['extratime'][0])
     fps = str(args['fps'][0])
+    segment = args['segment'][0]
+    profile = args['profile'][0]
+    encodetime = args['encodetime'][0]
+    proxy = args['proxy'][0]
+    decimate = args['decimate'][0]
+    composite = args['composite'][0]
+    compositematch = args['compositematch'][0]
+    maxframes = args['maxframes'][0]
+    vidlength = args['vidlength'][0]
 
     # Overrides
     global camparam1, camparam2, vidparam1, vidparam2
@@ -231,6 +319,10 @@ def init():
     else:        #  Ignore debug messages
         logger.setLevel(logging.INFO)
 
+    # File system operations report through the logger
+    global storage
+    storage = Storage(logger)
+
     # Create handler for console output - file output handler is created later if needed
     if nolog is False:  # Create log file as the default
         c_handler = logging.StreamHandler()
@@ -263,6 +355,10 @@ def init():
     global pid
     pid = str(os.getpid())
 
+    # ffmpeg reports progress on stdout for the status page
+    global ffmpegprogress
+    ffmpegprogress = ' -progress pipe:1 -nostats'
+
     # How much output
     if verbose:
         debug = ''
@@ -296,7 +392,6 @@ def init():
         logfilename = logname.replace(':', u'\u02f8')  # cannot use regular colon in windows file names
         logname = topdir + '\\' + logname  # This format used for HTML
         logfilename = topdir + '\\' + logfilename
-        cmd = 'mkdir "' + topdir + '"' + debug
     else:
         topdir = basedir + '/' + socket.getfqdn() + '/' + duetname
         baseworkingdir = topdir + '/' + pid  # may be changed later
@@ -304,14 +399,44 @@ def init():
         logfilename = logname.replace(':', u'\u02f8')  # cannot use regular colon in windows file names
         logname = topdir + '/' + logname  #  This format used for html
         logfilename = topdir + '/' + logfilename
-        cmd = 'mkdir -p "' + topdir + '"' + debug
-    
-    if runsubprocess(cmd) is False:
+
+    if storage.makedirs(topdir) is False:
         logger.debug('Could not create ' + topdir)
 
+    # History of the capture sets of every printer under basedir
+    global jobindex
+    jobindex = JobIndex(basedir, logger)
+
     #  Clean up files
     cleanupFiles('startup')
 
+    # Disk space limits for topdir
+    global retention
+    retention = Retention(topdir, quota * 1048576, minfree * 1048576, storage, logger, jobindex)
+    if retention.active():
+        retention.scan()
+
+    # Images held in RAM and written in batches
+    global writer
+    writer = None
+    if stage != '':
+        if stagesize < 1:
+            stagesize = 1
+        pidlist = getRunningInstancePids()
+        for dirs in os.listdir(stage) if os.path.isdir(stage) else []:  # left by instances that stopped
+            if dirs.isdigit() and dirs not in pidlist:
+                storage.rmtree(os.path.join(stage, dirs))
+        if storage.makedirs(os.path.join(stage, pid)) is False:
+            logger.info('Could not create ' + os.path.join(stage, pid) + ' - images will be written directly')
+        else:
+            writer = FrameWriter(os.path.join(stage, pid), stagesize * 1048576, frameStored, logger)
+
+    # Images resized as they arrive in the capture directory
+    global ingest
+    ingest = None
+    if ingestwidth > 0:
+        ingest = FrameIngest(ingestworkers, ingestFrame, frameStored, logger)
+
 ##  Set up log file now that we have a name for it
     if nolog is False:
         f_handler = logging.FileHandler(logfilename, mode='w', encoding='utf-8')
@@ -343,6 +468,16 @@ def init():
     logger.info("# deletepics      = {0:50s}".format(str(deletepics)))
     logger.info("# maxffmpeg       = {0:50s}".format(str(maxffmpeg)))
     logger.info("# keepfiles       = {0:50s}".format(str(keepfiles)))
+    logger.info("# resume          = {0:50s}".format(str(resume)))
+    logger.info("# quota           = {0:50s}".format(str(quota)))
+    logger.info("# minfree         = {0:50s}".format(str(minfree)))
+    logger.info("# stage           = {0:50s}".format(stage))
+    logger.info("# stagesize       = {0:50s}".format(str(stagesize)))
+    logger.info("# ingestwidth     = {0:50s}".format(str(ingestwidth)))
+    logger.info("# ingestquality   = {0:50s}".format(str(ingestquality)))
+    logger.info("# ingestworkers   = {0:50s}".format(str(ingestworkers)))
+    logger.info("# keeporiginal    = {0:50s}".format(str(keeporiginal)))
+    logger.info("# livezip         = {0:50s}".format(str(livezip)))
     logger.info("#Execution Setings:")
     logger.info("# dontwait        = {0:50s}".format(str(dontwait)))
     logger.info("# seconds         = {0:50s}".format(str(seconds)))
@@ -367,6 +502,17 @@ def init():
     logger.info("# Video Settings:")
     logger.info("# extratime       = {0:50s}".format(extratime))
     logger.info("# fps             = {0:50s}".format(str(fps)))
+    logger.info("# segment         = {0:50s}".format(str(segment)))
+    logger.info("# profile         = {0:50s}".format(profile))
+    if profile == 'auto':
+        logger.info("# encodetime      = {0:50s}".format(str(encodetime)))
+    logger.info("# proxy           = {0:50s}".format(str(proxy)))
+    logger.info("# decimate        = {0:50s}".format(str(decimate)))
+    if camera2 != '':
+        logger.info("# composite       = {0:50s}".format(composite))
+        logger.info("# compositematch  = {0:50s}".format(compositematch))
+    logger.info("# maxframes       = {0:50s}".format(str(maxframes)))
+    logger.info("# vidlength       = {0:50s}".format(str(vidlength)))
     if vidparam1 != '':
         logger.info("# Video1 Override:")
         logger.info("# vidparam1       = {0:50s}".format(vidparam1))
@@ -382,6 +528,18 @@ def init():
     # derived parameters
     ##############################################
 
+    # ffmpeg capacity is shared by every instance on this computer
+    global encodequeue
+    encodequeue = EncodeQueue(maxffmpeg, logger)
+
+    # Long file operations requested from the web UI
+    global jobs
+    jobs = JobRunner(2, logger)
+
+    # Listings for the file browser
+    global dircache
+    dircache = DirectoryCache(logger)
+
     # Polling interval should be at least = seconds so as not to miss interval
     if (poll > seconds) and (seconds != 0):
         poll = seconds  # Need to poll at least as often as seconds
@@ -452,8 +610,50 @@ def init():
         logger.info('************************************************************************************')
         sys.exit(2)
 
+    if (proxy < 0) or (proxy % 2 != 0):
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Invalid Combination: -proxy ' + str(proxy) + ' must be 0 or an even number of pixels')
+        logger.info('************************************************************************************')
+        sys.exit(2)
+
+    if decimate < 0:
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Invalid Combination: -decimate cannot be negative')
+        logger.info('************************************************************************************')
+        sys.exit(2)
+
+    if (decimate > 0) and (segment > 0):
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Invalid Combination: -decimate and -segment cannot be used together.')
+        logger.info('Segments are encoded from unbroken runs of frames.')
+        logger.info('************************************************************************************')
+        sys.exit(2)
+
+    if (maxframes < 0) or (vidlength < 0):
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Invalid Combination: -maxframes and -vidlength cannot be negative')
+        logger.info('************************************************************************************')
+        sys.exit(2)
+
+    if segment < 0:
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Invalid Combination: -segment ' + str(segment) + ' must be 0 or a positive number of frames')
+        logger.info('************************************************************************************')
+        sys.exit(2)
+
     # Information and Warnings
 
+    if (composite != 'none') and (camera2 == ''):
+        logger.info('')
+        logger.info('************************************************************************************')
+        logger.info('Warning: -composite ' + composite + ' ignored.  It needs -camera2.')
+        logger.info('************************************************************************************')
+
     if standby and (not httpListener):
         logger.info('')
         logger.info('************************************************************************************')
@@ -557,17 +757,6 @@ def init():
     if camera2 != '':
         checkDependencies(2)
 
-    # Check to see if ffmpeg supports tpad
-    # Done after checking that ffmpeg exist
-
-    if (not tpad_supported()) and (float(extratime) > 0):
-        logger.info('')
-        logger.info('************************************************************************************')
-        logger.info('Warning: This version of ffmpeg does not support -extratime')
-        logger.info('-extratime has been set to 0')
-        logger.info('************************************************************************************')
-        extratime = '0'
-
 
     global apiModel
 
@@ -625,115 +814,1956 @@ End of init()
 ##  Utility Functions
 #####################################################
 
-def make_archive(source, destination):
-    base = os.path.basename(destination)
-    format = pathlib.Path(destination).suffix
-    name = destination.replace(format,'')
-    format = format.replace('.','')
-    archive_from = os.path.dirname(source)
-    archive_to = os.path.basename(source.strip(os.sep))
-    try:
-        shutil.make_archive(name, format, archive_from, archive_to)
-        shutil.move('%s.%s' % (name, format), destination)
-        msg = ('Zip processing completed')
-    except Exception as msg1:
-        msg = 'Error: There was a problem creating the zip file --'
-        msg = msg + str(msg1)
-    return msg
-
 def createVideo(directory):
-    # loop through directory count # files and detect if Camera1 / Camera2
+    if directory == workingdir:  # Staged and resizing images are part of the video
+        framesSettled()
+    if directory == workingdir:  # Frames must not be decimated while they are being encoded
+        with decimatelock:
+            return cameraVideos(directory)
+    return cameraVideos(directory)
+
+def cameraVideos(directory):
+    # loop through directory count # files for each of Camera1 / Camera2
     msg = 'Create Video'
     logger.info(msg)
-    try:  #  Check to make sure we can create the video at the required destination
-        list = os.listdir(directory)
-    except OSError:
+    if not os.path.isdir(directory):  #  Check to make sure we can create the video at the required destination
         msg = 'Error: No permission or directory not found'
         logger.info(msg)
         return msg
 
-    cam1 = False
-    cam2 = False
-    frame = 0
-    Cameras = []
-    for name in list:
-        if not cam1:
-            if 'Camera1' in name:
-                cam1 = True
-                Cameras.append('Camera1')
-        elif not cam2:
-            if 'camera2' in name:
-                cam2 = True
-                Cameras.append('Camera2')
-        frame += 1
-
-    for cameraname in Cameras:
-        if frame < int(fps):
-            msg = 'Error: ' + cameraname + ': Cannot create video of less than 1 second: ' + fps + ' frames are required.'
-            logger.info(msg)
-            return msg
-
-        logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video')
-        if 250 < frame:
-            logger.info("This can take a while...")
+    frames = directoryFrames(directory)  # frame records for each camera
+    samples = {}  # one frame from each camera - used to find the image size
+    for cameraname in frames:
+        samples[cameraname] = cameraname + '_' + str(max(frames[cameraname])).zfill(8) + '.jpeg'
 
-        timestamp = time.strftime('%a-%H-%M', time.localtime())
+    Cameras = sorted(frames)
+    if not Cameras:
+        msg = 'Error: There are no images to make into a video'
+        logger.info(msg)
+        return msg
+    jobindex.update(directory, frames={cameraname: len(frames[cameraname]) for cameraname in Cameras},
+                    bytes=sum(record.get('b', 0) for records in frames.values() for record in records.values()))
 
-        fn = ' "' + directory + '_' + cameraname + '_' + timestamp + '.mp4"'
+    if composite != 'none' and len(Cameras) == 2 and vidparam1 == '' and vidparam2 == '':
+        msg = compositeVideo(directory, frames['Camera1'], frames['Camera2'],
+                             os.path.join(directory, samples['Camera1']))
+        return msg
 
-        if win:
-            cmd = 'ffmpeg' + ffmpegquiet + ' -r ' + fps + ' -i "' + directory + '\\' + cameraname + '_%08d.jpeg" -vcodec libx264 -y ' + fn + debug
-        else:
-            cmd = 'ffmpeg' + ffmpegquiet + ' -r ' + fps + ' -i "' + directory + '/' + cameraname + '_%08d.jpeg" -vcodec libx264 -y ' + fn + debug
+    # Each camera is encoded concurrently - encodequeue still limits the number of ffmpeg instances
+    workers = max(1, min(len(Cameras), maxffmpeg))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(cameraVideo, directory, cameraname, frames[cameraname],
+                               os.path.join(directory, samples[cameraname])) for cameraname in Cameras]
+        results = [future.result() for future in futures]
 
-        #  Wait for up to minutes for ffmpeg capacity to  become available
-        #  If still not available - try anyway
-        minutes = 5
-        increment = 15  #  seconds
-        loop = 0
-        while loop < minutes*60:
-            if ffmpeg_available():
-                break
+    msg = '<br>'.join(results)
+    return msg
+
+def cameraVideo(directory, cameraname, records, sample):
+    numbers = sorted(records)
+    frame = len(numbers)
+    if frame < int(fps):
+        msg = 'Error: ' + cameraname + ': Cannot create video of less than 1 second: ' + fps + ' frames are required.'
+        logger.info(msg)
+        return msg
+
+    selected = thinFrames(numbers, frameBudget(), frameLayers(records))
+    if len(selected) < frame:
+        logger.info(cameraname + ': using ' + str(len(selected)) + ' of ' + str(frame) + ' frames')
+        frame = len(selected)
+
+    logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video')
+    if 250 < frame:
+        logger.info("This can take a while...")
+
+    timestamp = time.strftime('%a-%H-%M', time.localtime())
+
+    videofile = directory + '_' + cameraname + '_' + timestamp + '.mp4'
+    fn = ' "' + videofile + '"'
+
+    if cameraname == 'Camera1':
+        vidparam = vidparam1
+    else:
+        vidparam = vidparam2
+
+    if vidparam != '':  # User supplied command replaces the encode profile
+        cmd = eval(vidparam)
+        encoding = 'vidparam'
+    else:
+        inputs, rate = frameInput(directory, cameraname, selected)
+        profilename = chooseProfile(cameraname, frame, sample)
+        options = rate + encodeOptions(profilename)
+        encoding = encodingName(profilename, sample)
+        if proxy > 0:  # The proxy and poster come from the same decode as the video
+            outputs = proxyOutputs(videofile, frame, options, rate)
+        else:
+            outputs = options + ' -y ' + fn
+        # No debug redirection - the progress report is read from stdout
+        cmd = 'ffmpeg' + ffmpegquiet + ffmpegprogress + inputs + outputs
+
+    encodestart = time.time()
+    result = None
+    held = False
+    # Only this instance has segments for its own frames - and they contain every frame
+    if segment > 0 and directory == workingdir and vidparam == '' and selected == numbers:
+        result = segmentVideo(directory, cameraname, frame, fn)
+        if result is not None:  # the still clip must match the segments
+            options = ' -r ' + fps + encodeOptions(segmentProfile())
+            encoding = encodingName(segmentProfile(), sample)
+
+    if result is None:  # No usable segments - encode every frame
+        with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname):
+            if vidparam != '':
+                result = runsubprocess(cmd)
             else:
-                time.sleep(increment)  # wait a while before trying again
-                loop += increment
-                logger.debug('Have waited ' + str(loop) + ' seconds for ffmpeg capacity')
+                result = runffmpeg(cmd, cameraname, frame)
+        if result is not False and vidparam == '' and float(extratime) > 0:
+            held = holdLastFrame(directory, cameraname, videofile, stillInput(directory, cameraname, selected[-1]), options)
+        if result is not False and proxy > 0 and vidparam != '':
+            makeProxy(videofile, cameraname)
+    elif result is not False:  # Segments were joined - nothing was decoded
+        if float(extratime) > 0:
+            held = holdLastFrame(directory, cameraname, videofile, stillInput(directory, cameraname, selected[-1]), options)
+        if proxy > 0:
+            makeProxy(videofile, cameraname)
+
+    try:
+        os.remove(os.path.join(directory, cameraname + '_frames.txt'))
+    except OSError:
+        pass
 
+    if result is False:
+        msg = ('!!!!!!!!!!!  There was a problem creating the video for '+cameraname+' !!!!!!!!!!!!!!!')
+        logger.info(msg)
+    else:
+        logger.info('Video processing completed for ' + cameraname)
+        logger.info('Video is in file ' + fn)
+        msg = cameraname + ': Video successfully created'
+        retention.added(videofile, proxyName(videofile), posterName(videofile))
+        recordSession(directory, cameraname, videofile, numbers[-1], encoding, frame, held)
+        jobindex.video(directory, videofile, time.time() - encodestart)
 
-        if runsubprocess(cmd) is False:
-            msg = ('!!!!!!!!!!!  There was a problem creating the video for '+cameraname+' !!!!!!!!!!!!!!!')
-            logger.info(msg)
+    return msg
+
+def sessionJob(directory):
+    # The job part of a working directory name i.e. [pid]_[job]
+    name = os.path.basename(directory)
+    if '_' not in name:
+        return ''
+    return name.split('_', 1)[1]
+
+def lineageName(job):
+    return os.path.join(topdir, job + '.sessions')
+
+def encodingName(profilename, sample):
+    # Videos with the same encoding name can be joined by stream copy
+    width, height = jpegSize(sample)
+    return profilename + ' ' + str(width) + 'x' + str(height)
+
+def recordSession(directory, cameraname, videofile, last, encoding, frames, held):
+    # Each video made from the working directory is appended to the lineage of its job
+    # so that a print split over restarts (or a crash) can be merged later.  encoding says
+    # whether videos can be joined by stream copy, frames and hold (-extratime seconds at
+    # the end) let the merge leave out the hold of every session but the last.
+    job = sessionJob(directory)
+    if directory != workingdir or job == '':
+        return
+    entry = {'session': session, 'pid': pid, 'camera': cameraname, 'video': os.path.basename(videofile),
+             'last': last, 'fps': fps, 'time': time.time(), 'encoding': encoding, 'frames': frames,
+             'hold': float(extratime) if held else 0}
+    with lineagelock:
+        try:
+            with open(lineageName(job), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            logger.debug('Could not record session for ' + job + ' ' + str(e))
+
+def readLineage(job):
+    entries = []
+    try:
+        with open(lineageName(job)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass  # partly written line
+    except OSError:
+        pass
+    return entries
+
+def lineageSessions(job):
+    # Sessions of the job in the order they started, including this one if it has frames
+    sessions = []
+    for entry in readLineage(job):
+        if entry.get('session') not in sessions:
+            sessions.append(entry.get('session'))
+    if workingdir_exists and session not in sessions:
+        sessions.append(session)
+    return sessions
+
+def mergeVideos():  # Run as a thread
+    job = sessionJob(workingdir) if workingdir_exists else sessionJob(baseworkingdir)
+    if job == '':
+        logger.info('Merge: there is no job name to find earlier sessions')
+        return
+    if workingdir_exists:  # Staged and resizing images are part of the merge
+        framesSettled()
+    entries = readLineage(job)
+    cameras = []
+    for entry in entries:
+        if entry.get('camera') not in cameras:
+            cameras.append(entry.get('camera'))
+    if workingdir_exists:
+        for cameraname in ['Camera1', 'Camera2']:
+            if cameraname not in cameras and (cameraname == 'Camera1' or camera2 != ''):
+                cameras.append(cameraname)
+
+    results = [mergeCamera(job, cameraname, entries) for cameraname in cameras]
+    if not results:
+        results = ['Merge: no sessions have been recorded for ' + job]
+    for result in results:
+        logger.info(result)
+
+def mergeCamera(job, cameraname, entries):
+    # Joins the latest video of every session - with stream copy if they were all encoded
+    # the same way.  Only frames of this session that are not yet in a video are encoded.
+    latest = {}
+    for entry in entries:
+        if entry.get('camera') == cameraname:
+            latest[entry['session']] = entry  # keeps the order sessions first appeared
+    parts = []  # video, entry
+    for entry in latest.values():
+        video = os.path.join(topdir, entry['video'])
+        if not os.path.isfile(video):
+            logger.info('Merge: ' + entry['video'] + ' is missing - skipped')
+            continue
+        parts.append((video, entry))
+
+    tail = ''
+    if workingdir_exists and cameraname in ['Camera1', 'Camera2']:
+        done = latest[session]['last'] if session in latest else 0
+        with decimatelock:
+            numbers = sorted(number for number in directoryFrames(workingdir).get(cameraname, {}) if number > done)
+            if numbers:
+                logger.info('Merge: ' + cameraname + ' encoding ' + str(len(numbers)) + ' frames not yet in a video')
+                tail = os.path.join(workingdir, cameraname + '_merge.mp4')
+                inputs, rate = frameInput(workingdir, cameraname, numbers)
+                cmd = 'ffmpeg' + ffmpegquiet + ffmpegprogress + inputs + rate + encodeOptions(segmentProfile())
+                cmd = cmd + ' -y "' + tail + '"'
+                with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname + ' merge'):
+                    result = runffmpeg(cmd, cameraname + ' merge', len(numbers))
+                try:
+                    os.remove(os.path.join(workingdir, cameraname + '_frames.txt'))
+                except OSError:
+                    pass
+                if result is False:
+                    return '!!!!!!!!!!!  There was a problem merging the video for ' + cameraname + ' !!!!!!!!!!!!!!!'
+                sample = os.path.join(workingdir, cameraname + '_' + str(numbers[0]).zfill(8) + '.jpeg')
+                parts.append((tail, {'fps': fps, 'frames': len(numbers), 'hold': 0,
+                                     'encoding': encodingName(segmentProfile(), sample)}))
+
+    if len(parts) < 2:
+        msg = 'Merge: ' + cameraname + ' has only ' + str(len(parts)) + ' session video - nothing to merge'
+    else:
+        timestamp = time.strftime('%a-%H-%M', time.localtime())
+        videofile = os.path.join(topdir, job + '_' + cameraname + '_Merged_' + timestamp + '.mp4')
+        listfile = os.path.join(topdir, job + '_' + cameraname + '_merge.txt')
+        with open(listfile, 'w') as f:
+            for index, (part, entry) in enumerate(parts):
+                f.write("file '" + part.replace("'", "'\\''") + "'\n")
+                if entry.get('hold', 0) > 0 and entry.get('frames') and index < len(parts) - 1:
+                    # The -extratime hold of a session would stop the video part way through
+                    f.write('outpoint ' + str(round(entry['frames'] / float(entry['fps']), 3)) + '\n')
+        encodings = set((entry.get('encoding'), entry.get('fps')) for _, entry in parts)
+        encoding, _ = next(iter(encodings))
+        if len(encodings) == 1 and encoding is not None and encoding != 'vidparam':
+            cmd = 'ffmpeg' + ffmpegquiet + ' -f concat -safe 0 -i "' + listfile + '" -c copy -y "' + videofile + '"' + debug
+            result = runsubprocess(cmd)  # Stream copy - no ffmpeg capacity needed
         else:
-            logger.info('Video processing completed for ' + cameraname)
-            logger.info('Video is in file ' + fn)
-            msg = 'Video(s) successfully created'
+            logger.info('Merge: ' + cameraname + ' sessions were not all encoded the same way - re-encoding')
+            total = sum(entry.get('frames', 0) for _, entry in parts)
+            options = ' -r ' + fps + encodeOptions(profile if profile != 'auto' else 'balanced')
+            size = parts[0][1].get('encoding', '').split(' ')[-1].split('x')
+            if len(size) == 2 and size[0].isdigit() and int(size[0]) > 0:  # every session at the size of the first
+                w, h = size
+                options = (' -vf "scale=' + w + ':' + h + ':force_original_aspect_ratio=decrease,pad=' + w + ':' + h
+                           + ':(ow-iw)/2:(oh-ih)/2,setsar=1"' + options)
+            cmd = 'ffmpeg' + ffmpegquiet + ffmpegprogress + ' -f concat -safe 0 -i "' + listfile + '"' + options
+            cmd = cmd + ' -y "' + videofile + '"'
+            with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname + ' merge'):
+                result = runffmpeg(cmd, cameraname + ' merge', total)
+        if result is False:
+            msg = '!!!!!!!!!!!  There was a problem merging the video for ' + cameraname + ' !!!!!!!!!!!!!!!'
+        else:
+            msg = 'Merge: ' + cameraname + ' ' + str(len(parts)) + ' parts joined in ' + videofile
+            if proxy > 0:
+                makeProxy(videofile, cameraname)
+            retention.added(videofile, proxyName(videofile), posterName(videofile))
+        try:
+            os.remove(listfile)
+        except OSError:
+            pass
 
+    if tail != '':
+        try:
+            os.remove(tail)
+        except OSError:
+            pass
     return msg
 
-def tpad_supported():
-    if win:
-        cmd = 'ffmpeg -filters | findstr "tpad"'
+def frameTime(directory, cameraname, number, record):
+    if 't' in record:
+        return record['t']
+    try:  # captured before the manifest existed
+        return os.path.getmtime(os.path.join(directory, cameraname + '_' + str(number).zfill(8) + '.jpeg'))
+    except OSError:
+        return 0
+
+def matchFrames(directory, records1, selected1, records2):
+    # Camera2 frame number to show with each selected Camera1 frame
+    numbers1 = sorted(records1)
+    numbers2 = sorted(records2)
+    if compositematch == 'time':  # nearest capture time
+        times2 = sorted((frameTime(directory, 'Camera2', number, records2[number]), number) for number in numbers2)
+        keys = [t for t, _ in times2]
+        matched = []
+        for number in selected1:
+            t = frameTime(directory, 'Camera1', number, records1[number])
+            i = bisect.bisect_left(keys, t)
+            nearest = [j for j in [i - 1, i] if 0 <= j < len(keys)]
+            j = min(nearest, key=lambda j: abs(keys[j] - t))
+            matched.append(times2[j][1])
+        return matched
+    # same position in each camera's sequence
+    position = {number: index for index, number in enumerate(numbers1)}
+    return [numbers2[min(position[number], len(numbers2) - 1)] for number in selected1]
+
+def compositeGraph(sample):
+    # Camera1 is input 0, Camera2 is input 1.  Camera2 is scaled to fit Camera1 keeping its own shape.
+    # The size comes from a Camera1 image (sample) - scale2ref drops frames at random in ffmpeg 7
+    # so it is only used if the image cannot be read.  In scale2ref iw / ih are the size of the
+    # reference (Camera1) and mdar is the aspect ratio of the input being scaled (Camera2).
+    # The video ends with the last Camera1 frame (shortest=1).
+    width, height = jpegSize(sample)
+    if width == 0:
+        if composite == 'hstack':
+            graph = '[1:v][0:v]scale2ref=w=oh*mdar:h=ih[right][left];[left][right]hstack=shortest=1'
+        elif composite == 'vstack':
+            graph = '[1:v][0:v]scale2ref=w=iw:h=ow/mdar[bottom][top];[top][bottom]vstack=shortest=1'
+        else:
+            graph = '[1:v][0:v]scale2ref=w=iw/4:h=ow/mdar[inset][main];[main][inset]overlay=W-w-10:H-h-10:shortest=1'
+    elif composite == 'hstack':
+        graph = '[1:v]scale=-2:' + str(height) + '[right];[0:v][right]hstack=shortest=1'
+    elif composite == 'vstack':
+        graph = '[1:v]scale=' + str(width) + ':-2[bottom];[0:v][bottom]vstack=shortest=1'
+    else:  # pip - Camera2 inset in the bottom right corner of Camera1
+        graph = '[1:v]scale=' + str(max(2, width // 8 * 2)) + ':-2[inset];[0:v][inset]overlay=W-w-10:H-h-10:shortest=1'
+    # Both inputs are retimed to one frame per 1/fps - concat list timestamps do not line up with
+    # the image pattern and the stack would otherwise emit a frame for each of them
+    retime = '[0:v]setpts=N/' + fps + '/TB[c1];[1:v]setpts=N/' + fps + '/TB[c2];'
+    graph = retime + graph.replace('[0:v]', '[c1]').replace('[1:v]', '[c2]')
+    return graph + ',scale=trunc(iw/2)*2:trunc(ih/2)*2[composite]'  # x264 needs even sizes
+
+def compositeVideo(directory, records1, records2, sample):
+    # Both cameras in one video with a single decode of each frame
+    numbers1 = sorted(records1)
+    frame = len(numbers1)
+    if frame < int(fps):
+        msg = 'Error: Composite: Cannot create video of less than 1 second: ' + fps + ' frames are required.'
+        logger.info(msg)
+        return msg
+
+    selected1 = thinFrames(numbers1, frameBudget(), frameLayers(records1))
+    selected2 = matchFrames(directory, records1, selected1, records2)
+    frame = len(selected1)
+    logger.info('Composite: now making ' + str(frame) + ' frames from each camera into a ' + composite + ' video')
+    if 250 < frame:
+        logger.info("This can take a while...")
+
+    timestamp = time.strftime('%a-%H-%M', time.localtime())
+    videofile = directory + '_Composite_' + timestamp + '.mp4'
+    fn = ' "' + videofile + '"'
+
+    input1, _ = frameInput(directory, 'Camera1', selected1)
+    # Camera2 may have frames after the last one matched - the pattern would decode them too
+    input2, _ = frameInput(directory, 'Camera2', selected2, False)
+    rate = ' -r ' + fps
+    profilename = chooseProfile('Composite', frame, sample)
+    options = rate + encodeOptions(profilename)
+    if proxy > 0:
+        outputs = proxyOutputs(videofile, frame, options, rate, compositeGraph(sample) + ';', '[composite]')
+    else:
+        outputs = ' -filter_complex "' + compositeGraph(sample) + '" -map "[composite]"' + options + ' -y ' + fn
+    cmd = 'ffmpeg' + ffmpegquiet + ffmpegprogress + input1 + input2 + outputs
+
+    encodestart = time.time()
+    with encodequeue.slot(pid + ' ' + duetname + ' Composite'):
+        result = runffmpeg(cmd, 'Composite', frame)
+    held = False
+    if result is not False and float(extratime) > 0:
+        stills = stillInput(directory, 'Camera1', selected1[-1]) + stillInput(directory, 'Camera2', selected2[-1])
+        held = holdLastFrame(directory, 'Composite', videofile, stills,
+                      ' -filter_complex "' + compositeGraph(sample) + '" -map "[composite]"' + options)
+
+    for cameraname in ['Camera1', 'Camera2']:
+        try:
+            os.remove(os.path.join(directory, cameraname + '_frames.txt'))
+        except OSError:
+            pass
+
+    if result is False:
+        msg = '!!!!!!!!!!!  There was a problem creating the composite video !!!!!!!!!!!!!!!'
+        logger.info(msg)
     else:
-        cmd = 'ffmpeg -filters | grep tpad'
+        logger.info('Video processing completed for Composite')
+        logger.info('Video is in file ' + fn)
+        msg = 'Composite: Video successfully created'
+        retention.added(videofile, proxyName(videofile), posterName(videofile))
+        recordSession(directory, 'Composite', videofile, numbers1[-1],
+                      encodingName(profilename, sample) + ' ' + composite, frame, held)
+        jobindex.video(directory, videofile, time.time() - encodestart)
+    return msg
 
-    if runsubprocess(cmd) is False:
-        logger.info('This version of ffmpeg does not support tpad')
+def frameBudget():
+    # Maximum number of frames in a video - 0 for no limit
+    budget = maxframes
+    if vidlength > 0:
+        lengthframes = max(1, int(vidlength * int(fps)))
+        if budget == 0 or lengthframes < budget:
+            budget = lengthframes
+    return budget
+
+def thinFrames(numbers, budget, layers=None):
+    # Evenly spaced selection of frame numbers that keeps the first and last frames.
+    # With layers (frame number : layer) the last frame of every layer is kept first.
+    if budget <= 0 or len(numbers) <= budget:
+        return numbers
+    if budget == 1:
+        return numbers[-1:]
+    if layers:
+        lastframes = [number for index, number in enumerate(numbers)
+                      if index == len(numbers) - 1 or layers.get(numbers[index + 1]) != layers.get(number)]
+        if len(lastframes) >= budget:
+            return thinFrames(lastframes, budget)
+        keep = set(lastframes)
+        others = [number for number in numbers if number not in keep]
+        return sorted(keep.union(thinFrames(others, budget - len(lastframes))))
+    step = (len(numbers) - 1) / (budget - 1)
+    return [numbers[round(i * step)] for i in range(budget)]
+
+def frameLayers(records):
+    # frame number : layer - or None if the layers were not recorded
+    layers = {number: record.get('l', -1) for number, record in records.items()}
+    if not any(layer >= 0 for layer in layers.values()):
+        return None
+    return layers
+
+def directoryFrames(directory):
+    # {cameraname: {number: record}} from the frame manifest (or the directory for older captures)
+    if directory == workingdir and manifest is not None:
+        return manifest.frames()
+    return FrameManifest(directory).frames()
+
+def frameInput(directory, cameraname, numbers, pattern=True):
+    # Returns the ffmpeg input and the output frame rate option for the frame numbers.
+    # Frames numbered 1 to n use the image pattern (unless pattern is False).  Otherwise a concat
+    # list names each frame so that frames that were left out are never decoded.
+    if pattern and numbers == list(range(1, len(numbers) + 1)):
+        return ' -r ' + fps + ' -i "' + os.path.join(directory, cameraname + '_%08d.jpeg') + '"', ''
+
+    listfile = os.path.join(directory, cameraname + '_frames.txt')
+    duration = str(1 / float(fps))
+    with open(listfile, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for number in numbers:
+            f.write('file ' + cameraname + '_' + str(number).zfill(8) + '.jpeg\n')
+            f.write('duration ' + duration + '\n')  # the last file too - repeating it would add a frame
+    return ' -f concat -safe 0 -i "' + listfile + '"', ' -r ' + fps
+
+def runffmpeg(cmd, label, total):
+    # Runs an ffmpeg command that uses ffmpegprogress and keeps encodeprogress[label] up to date
+    # Changes are made under encodeprogresslock - readers take a copy with encodeProgress()
+    progress = {'frames': 0, 'total': total, 'fps': 0.0, 'speed': '', 'eta': -1, 'state': 'encoding',
+                'started': time.time(), 'finished': 0}
+    with encodeprogresslock:
+        encodeprogress[label] = progress
+    output = []
+    try:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        values = {}
+        for line in proc.stdout:
+            key, equals, value = line.strip().partition('=')
+            if not equals:
+                output.append(line)
+                continue
+            values[key] = value.strip()
+            if key == 'progress':  # Last line of each progress report
+                with encodeprogresslock:
+                    try:
+                        progress['frames'] = int(values.get('frame', 0))
+                        progress['fps'] = float(values.get('fps', 0))
+                    except ValueError:
+                        pass
+                    progress['speed'] = values.get('speed', '')
+                    if progress['fps'] > 0:
+                        progress['eta'] = int(max(0, total - progress['frames']) / progress['fps'])
+        proc.wait()
+    except OSError as e:
+        logger.info('Command Exception: ' + str(cmd))
+        logger.info(str(e))
+        with encodeprogresslock:
+            progress['state'] = 'failed'
+            progress['finished'] = time.time()
         return False
 
+    if proc.returncode != 0:
+        logger.info('Command Failure: ' + str(cmd))
+        logger.debug(''.join(output))
+        with encodeprogresslock:
+            progress['state'] = 'failed'
+            progress['finished'] = time.time()
+        return False
+    logger.info('Command Success : ' + str(cmd))
+    with encodeprogresslock:
+        progress['state'] = 'completed'
+        progress['finished'] = time.time()
+        progress['frames'] = total
+        progress['eta'] = 0
     return True
 
-def ffmpeg_available():
-    count = 0
-    max_count = maxffmpeg  # Default is 2
-    for p in psutil.process_iter():
-        if 'ffmpeg' in p.name():  # Check to see if it's running
-            count += 1
-        if count >= max_count:
-            logger.info('Waiting for ffmpeg to become available')
+def encodeProgress():
+    # A copy of encodeprogress that is safe to read (e.g. json.dumps) while encodes update it
+    with encodeprogresslock:
+        return {label: dict(progress) for label, progress in encodeprogress.items()}
+
+def progressText():
+    # One line per encode for the status page
+    txt = []
+    for label, progress in encodeProgress().items():
+        if progress['state'] == 'encoding':
+            line = 'Encoding ' + label + ':  ' + str(progress['frames']) + ' of ' + str(progress['total']) + ' frames'
+            if progress['eta'] >= 0:
+                line = line + ' at ' + str(progress['fps']) + ' fps (' + progress['speed'] + ')'
+                line = line + ' - about ' + str(progress['eta'] // 60 + 1) + ' min remaining'
+        else:
+            line = 'Encoding ' + label + ':  ' + progress['state'] + ' at ' + time.strftime('%H:%M', time.localtime(progress['finished']))
+        txt.append(line)
+    return txt
+
+def statusData():
+    # State of this instance for /api/status
+    cameras = {'Camera1': {'camera': camera1, 'frames': frame1, 'lastcapture': timePriorPhoto1 if frame1 > 0 else None}}
+    if camera2 != '':
+        cameras['Camera2'] = {'camera': camera2, 'frames': frame2, 'lastcapture': timePriorPhoto2 if frame2 > 0 else None}
+    waiting = [{'label': label, 'position': position} for label, position in list(encodequeue.positions.values())]
+    return {'version': duetLapse3Version, 'printer': duet, 'duetname': duetname, 'pid': pid, 'port': port,
+            'action': action, 'printState': printState, 'duetStatus': duetStatus,
+            'layer': zo1 if isinstance(zo1, int) and zo1 >= 0 else None,  # 'disconnected' if the printer did not answer
+            'cameras': cameras, 'workingdir': workingdir if workingdir_exists else '',
+            'poll': {'interval': poll, 'latency': polllatency, 'last': lastpoll},
+            'encode': {'waiting': waiting, 'progress': encodeProgress()},
+            'jobs': [job for job in jobs.list() if job['state'] in ['queued', 'running']],
+            'time': time.time()}
+
+def proxyName(videofile):
+    return videofile[:-len('.mp4')] + '_proxy.mp4'
+
+def posterName(videofile):
+    return videofile[:-len('.mp4')] + '_poster.jpg'
+
+def proxyOutputs(videofile, frame, options, rate, graph='', source='[0:v]'):
+    # ffmpeg outputs for the video, a -proxy high preview and a poster of the last frame
+    # graph is an optional filter graph that ends with the source label
+    graph = graph + source + 'split=3[full][small][last];[small]scale=-2:' + str(proxy) + '[proxy];'
+    graph = graph + "[last]select='eq(n," + str(frame - 1) + ")'[poster]"
+    outputs = ' -filter_complex "' + graph + '"'
+    outputs = outputs + ' -map "[full]"' + options + ' -y "' + videofile + '"'
+    outputs = outputs + ' -map "[proxy]"' + rate + encodeOptions('fast-preview') + ' -y "' + proxyName(videofile) + '"'
+    outputs = outputs + ' -map "[poster]" -frames:v 1 -y "' + posterName(videofile) + '"'
+    return outputs
+
+def makeProxy(videofile, cameraname):
+    # Used when the video was not made from the frames in a single pass
+    cmd = 'ffmpeg' + ffmpegquiet + ' -i "' + videofile + '" -vf scale=-2:' + str(proxy)
+    cmd = cmd + encodeOptions('fast-preview') + ' -y "' + proxyName(videofile) + '"' + debug
+    with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname + ' proxy'):
+        if runsubprocess(cmd) is False:
+            logger.info('There was a problem creating the preview for ' + cameraname)
+    cmd = 'ffmpeg' + ffmpegquiet + ' -sseof -1 -i "' + videofile + '" -update 1 -y "' + posterName(videofile) + '"' + debug
+    if runsubprocess(cmd) is False:
+        logger.info('There was a problem creating the poster for ' + cameraname)
+
+def stillInput(directory, cameraname, number):
+    # A single frame repeated for -extratime seconds
+    return ' -loop 1 -framerate ' + fps + ' -t ' + extratime + ' -i "' + os.path.join(directory, cameraname + '_' + str(number).zfill(8) + '.jpeg') + '"'
+
+def holdLastFrame(directory, cameraname, videofile, inputs, options):
+    # Appends -extratime seconds of the last frame.  Only the short still clip is encoded (with the
+    # same settings as the video) and it is joined to the video by stream copy.
+    hold = os.path.join(directory, cameraname + '_hold.mp4')
+    joined = os.path.join(directory, cameraname + '_held.mp4')
+    listfile = os.path.join(directory, cameraname + '_hold.txt')
+    cmd = 'ffmpeg' + ffmpegquiet + inputs + options + ' -y "' + hold + '"' + debug
+    with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname + ' extratime'):
+        result = runsubprocess(cmd)
+    if result is not False:
+        with open(listfile, 'w') as f:
+            for part in [videofile, hold]:
+                f.write("file '" + part.replace("'", "'\\''") + "'\n")
+        cmd = 'ffmpeg' + ffmpegquiet + ' -f concat -safe 0 -i "' + listfile + '" -c copy -y "' + joined + '"' + debug
+        result = runsubprocess(cmd)
+    if result is not False:
+        try:
+            os.replace(joined, videofile)
+        except OSError as e:
+            logger.debug(str(e))
+            result = False
+    if result is False:  # The video itself is still usable
+        logger.info(cameraname + ': could not add -extratime - the video does not hold the last frame')
+    for part in [hold, joined, listfile]:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+    return result is not False
+
+def availableCores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on Windows
+        return os.cpu_count() or 1
+
+def jpegSize(filename):
+    # Returns width, height from the jpeg frame header - or 0, 0 if it cannot be read
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return 0, 0
+            while True:
+                marker = f.read(2)
+                if len(marker) != 2 or marker[0] != 0xff:
+                    return 0, 0
+                length = int.from_bytes(f.read(2), 'big')
+                if marker[1] in [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]:
+                    header = f.read(5)
+                    return int.from_bytes(header[3:5], 'big'), int.from_bytes(header[1:3], 'big')
+                f.seek(length - 2, 1)
+    except OSError:
+        return 0, 0
+
+def encodeThreads():
+    # Share the cores between the ffmpeg instances that are allowed to run at once
+    return max(1, availableCores() // maxffmpeg)
+
+def chooseProfile(cameraname, frame, sample):
+    if profile != 'auto':
+        return profile
+    width, height = jpegSize(sample)
+    if width == 0:
+        logger.info(cameraname + ': could not read the image size - using the balanced encode profile')
+        return 'balanced'
+    # Best quality profile that is expected to finish within -encodetime
+    for name in ['archive', 'balanced', 'fast-preview']:
+        rate = balancedrate * encodeprofiles[name]['speed'] * encodeThreads()
+        estimate = frame * width * height / rate
+        if estimate <= encodetime:
+            break
+    logger.info(cameraname + ': using the ' + name + ' encode profile for ' + str(frame) + ' frames of ' + str(width)
+                + 'x' + str(height) + ' - estimated encode time ' + str(int(estimate)) + ' seconds')
+    return name
+
+def segmentProfile():
+    # Segments are joined without re-encoding so they (and the tail) must all use the same settings
+    if profile == 'auto':
+        return 'fast-preview'
+    return profile
+
+def encodeOptions(profilename):
+    settings = encodeprofiles[profilename]
+    options = ' -vcodec libx264 -preset ' + settings['preset'] + ' -crf ' + settings['crf']
+    options = options + ' -pix_fmt ' + settings['pixfmt'] + ' -threads ' + str(encodeThreads())
+    return options
+
+def encodeFrames(directory, cameraname, start, count, thisfps, outfile):
+    # Encodes count frames beginning at frame number start
+    cmd = 'ffmpeg' + ffmpegquiet + ffmpegprogress + ' -r ' + thisfps + ' -start_number ' + str(start)
+    cmd = cmd + ' -i "' + os.path.join(directory, cameraname + '_%08d.jpeg') + '"'
+    cmd = cmd + ' -frames:v ' + str(count) + encodeOptions(segmentProfile()) + ' -y "' + outfile + '"'
+    with encodequeue.slot(pid + ' ' + duetname + ' ' + cameraname + ' segment'):
+        return runffmpeg(cmd, cameraname + ' segment', count)
+
+def queueDecimation():
+    # Starts a background decimation if one is due
+    global lastdecimation
+    if decimate <= 0:
+        return
+    interval = max(60, decimate * 60 / 2)  # seconds
+    if time.time() - lastdecimation < interval:
+        return
+    lastdecimation = time.time()
+    threading.Thread(target=decimateFrames, args=(workingdir,), daemon=True).start()
+
+def keepFrame(number, age):
+    # All frames younger than -decimate minutes are kept.  Beyond that, each doubling of age
+    # keeps half as many frames: every 2nd, then every 4th ...
+    # Using the frame number means each pass only removes frames that a later pass would also remove.
+    window = decimate * 60
+    if age < window:
+        return True
+    step = 2 ** (int(math.log2(age / window)) + 1)
+    return number % step == 0
+
+def decimateFrames(directory):  # Run as a thread
+    if not decimatelock.acquire(blocking=False):
+        return  # A video is being made - try again later
+    try:
+        now = time.time()
+        removed = 0
+        freed = 0
+        for cameraname, records in directoryFrames(directory).items():
+            gone = []
+            for number, record in records.items():
+                framefile = os.path.join(directory, cameraname + '_' + str(number).zfill(8) + '.jpeg')
+                if keepFrame(number, now - frameTime(directory, cameraname, number, record)):
+                    continue
+                size = record.get('b', 0)
+                try:
+                    if not size:
+                        size = os.path.getsize(framefile)
+                    os.remove(framefile)
+                except OSError:
+                    continue
+                gone.append(number)
+                freed += size
+            if gone and directory == workingdir and manifest is not None:
+                manifest.remove(cameraname, gone)
+            removed += len(gone)
+        if removed > 0:
+            logger.info('Decimation removed ' + str(removed) + ' older frames (' + str(freed // 1048576) + ' MB)')
+    finally:
+        decimatelock.release()
+
+def queueSegments(cameraname):
+    # Starts a background segment encode for this camera - unless one is already running
+    if segment <= 0:
+        return
+    thread = segmentthreads.get(cameraname)
+    if thread is not None and thread.is_alive():
+        return
+    thread = threading.Thread(target=encodeSegments, args=(cameraname,), daemon=True)
+    segmentthreads[cameraname] = thread
+    thread.start()
+
+def encodeSegments(cameraname):  # Run as a thread
+    # Encodes every complete segment of frames that has not yet been encoded
+    global segmentfps
+    directory = workingdir
+    run = segmentrun
+    while True:
+        thisfps = fps
+        with segmentlock:
+            if run != segmentrun:  # restarted - the working directory may have the same name
+                return
+            if segmentfps not in ['', thisfps]:  # fps was changed - earlier segments cannot be joined
+                discardSegments()
+            if segments[cameraname]:
+                done = segments[cameraname][-1][1]
+            else:
+                done = 0
+
+        if cameraname == 'Camera1':
+            captured = frame1
+        else:
+            captured = frame2
+        for stagehandler in [writer, ingest]:  # Only frames that are ready in the directory
+            if stagehandler is not None and stagehandler.first(cameraname) is not None:
+                captured = min(captured, stagehandler.first(cameraname) - 1)
+        # The newest frame may still be being written - so it is never part of a segment
+        if captured - 1 - done < segment:
+            return
+
+        start = done + 1
+        outfile = os.path.join(directory, cameraname + '_segment_' + str(run) + '_' + str(start).zfill(8) + '.mp4')
+        logger.info(cameraname + ': encoding segment of frames ' + str(start) + ' to ' + str(done + segment))
+        if encodeFrames(directory, cameraname, start, segment, thisfps, outfile) is False:
+            logger.info('!!!!!!!!!!!  There was a problem creating a video segment for ' + cameraname + ' !!!!!!!!!!!')
+            return
+
+        with segmentlock:
+            if run != segmentrun or directory != workingdir or segmentfps not in ['', thisfps]:
+                # restarted or fps changed while encoding
+                try:
+                    os.remove(outfile)
+                except OSError:
+                    pass
+                return
+            segmentfps = thisfps
+            segments[cameraname].append((start, done + segment, outfile))
+
+def discardSegments():
+    # Called with segmentlock held
+    global segmentfps
+    for cameraname in segments:
+        for _, _, outfile in segments[cameraname]:
+            try:
+                os.remove(outfile)
+            except OSError:
+                pass
+        segments[cameraname] = []
+    segmentfps = ''
+
+def segmentVideo(directory, cameraname, frame, fn):
+    # Joins the completed segments and an encode of only the remaining frames.
+    # Returns None if there are no usable segments
+    with segmentlock:
+        if segmentfps != fps:  # fps was changed since the segments were made
+            discardSegments()
+        parts = [outfile for _, _, outfile in segments[cameraname]]
+        if parts:
+            done = segments[cameraname][-1][1]
+    if not parts:
+        return None
+
+    tail = os.path.join(directory, cameraname + '_tail.mp4')
+    if done < frame:
+        logger.info(cameraname + ': joining ' + str(len(parts)) + ' segments with ' + str(frame - done) + ' new frames')
+        if encodeFrames(directory, cameraname, done + 1, frame - done, fps, tail) is False:
+            return False
+        parts.append(tail)
+
+    listfile = os.path.join(directory, cameraname + '_concat.txt')
+    with open(listfile, 'w') as f:
+        for part in parts:
+            f.write("file '" + part.replace("'", "'\\''") + "'\n")
+
+    cmd = 'ffmpeg' + ffmpegquiet + ' -f concat -safe 0 -i "' + listfile + '" -c copy -y ' + fn + debug
+    result = runsubprocess(cmd)  # Stream copy - no ffmpeg capacity needed
+
+    for part in [tail, listfile]:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+    return result
+
+class FrameManifest:
+    # Append-only record of the frames in a directory.  One compact json line per frame:
+    # c camera, n frame number, l layer, z Z position, t time, m monotonic time,
+    # tr trigger, d capture duration (sec), b bytes.  A line with x set removes frame n.
+    # Directories made before the manifest existed are read by listing the directory.
+    filename = 'frames.jsonl'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+        self.lock = threading.Lock()
+        self.records = {}  # cameraname : {number : record}
+        self.offset = 0  # bytes of the manifest already read
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def append(self, record):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def remove(self, cameraname, numbers):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                for number in numbers:
+                    f.write(json.dumps({'c': cameraname, 'n': number, 'x': 1}, separators=(',', ':')) + '\n')
+
+    def frames(self):
+        # {cameraname: {number: record}} - only lines added since the last call are read
+        with self.lock:
+            if not self.exists():
+                return self.scan()
+            try:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except OSError:
+                data = b''
+            end = data.rfind(b'\n') + 1  # a partly written line is read next time
+            self.offset += end
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                    numbers = self.records.setdefault(record['c'], {})
+                    if record.get('x'):
+                        numbers.pop(record['n'], None)
+                    else:
+                        numbers[record['n']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+            return {cameraname: dict(numbers) for cameraname, numbers in self.records.items() if numbers}
+
+    def scan(self):
+        frames = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return frames
+        for name in names:
+            if not name.endswith('.jpeg'):
+                continue
+            cameraname = name.split('_', 1)[0]
+            if cameraname in ['Camera1', 'Camera2']:
+                try:
+                    frames.setdefault(cameraname, {})[int(name[len(cameraname) + 1:-len('.jpeg')])] = {}
+                except ValueError:
+                    continue
+        return frames
+
+    def summary(self):
+        # Short description for file listings e.g. Camera1 240 frames layers 1-85
+        if not self.exists():
+            return ''
+        txt = []
+        for cameraname, numbers in sorted(self.frames().items()):
+            layers = [record.get('l', -1) for record in numbers.values() if record.get('l', -1) >= 0]
+            text = cameraname + ' ' + str(len(numbers)) + ' frames'
+            if layers:
+                text = text + ' layers ' + str(min(layers)) + '-' + str(max(layers))
+            txt.append(text)
+        return ', '.join(txt)
+
+def byteRange(header, size):
+    # (start, end) of a single bytes range, None if the header is ignored and the whole file is sent
+    # (e.g. malformed), False if the range is unsatisfiable (416)
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None  # multiple ranges are answered with the whole file
+    first, dash, last = header[len('bytes='):].strip().partition('-')
+    if not dash or not (first or last) or not set(first + last) <= set('0123456789'):
+        return None
+    if first == '':  # the final bytes
+        if int(last) == 0 or size == 0:
             return False
-    logger.info('There are ' + str(count) + ' instances of ffmpeg running')
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    if last != '' and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last != '' else size - 1
+
+def sendFile(handler, path, ctype, logger, head=False):
+    # Sends a file with HEAD, conditional (ETag / Last-Modified - 304) and Range (206) support.
+    # The body is sent by the kernel (sendfile) where the platform allows.
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        logger.info('Problem opening file: ' + path)
+        handler.send_error(404, 'File not found')
+        return
+    with f:
+        fs = os.fstat(f.fileno())
+        size = fs.st_size
+        etag = '"' + format(fs.st_mtime_ns, 'x') + '-' + format(size, 'x') + '"'
+        lastmodified = handler.date_time_string(int(fs.st_mtime))
+
+        notmodified = False
+        if handler.headers.get('If-None-Match'):
+            notmodified = etag in [tag.strip() for tag in handler.headers['If-None-Match'].split(',')] \
+                          or handler.headers['If-None-Match'].strip() == '*'
+        elif handler.headers.get('If-Modified-Since'):
+            try:
+                since = email.utils.parsedate_to_datetime(handler.headers['If-Modified-Since']).timestamp()
+                notmodified = int(fs.st_mtime) <= since
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+        if notmodified:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Last-Modified', lastmodified)
+            handler.end_headers()
+            return
+
+        span = byteRange(handler.headers.get('Range'), size)
+        ifrange = handler.headers.get('If-Range')
+        if span is not None and ifrange and ifrange.strip() not in [etag, lastmodified]:
+            span = None  # the file has changed - send all of it
+        if span is False:
+            handler.send_response(416)
+            handler.send_header('Content-Range', 'bytes */' + str(size))
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        if span is None:
+            start, end = 0, size - 1
+            handler.send_response(200)
+        else:
+            start, end = span
+            handler.send_response(206)
+            handler.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+        handler.send_header('Content-type', ctype)
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('ETag', etag)
+        handler.send_header('Last-Modified', lastmodified)
+        handler.end_headers()
+        if head or end < start:
+            return
+        try:
+            handler.connection.sendfile(f, start, end - start + 1)
+        except (ConnectionError, socket.timeout):
+            logger.info('Connection reset - normal if displaying file')
+        except OSError as e:
+            logger.info('Error sending file ' + str(e))
+
+
+def archiveCurrent(directory):
+    # True if directory has a completed -livezip archive made after its last change
+    try:
+        made = os.path.getmtime(directory + '.zip')
+    except OSError:
+        return False
+    for name in [FrameManifest.filename, '']:
+        try:
+            if os.path.getmtime(os.path.join(directory, name)) > made:
+                return False
+        except OSError:
+            pass
     return True
 
+class FrameWriter:
+    # Images are captured into a staging directory (e.g. tmpfs) and copied to the capture
+    # directory in batches - one sequential run of writes and one flush to disk per batch
+    # instead of a small write for every image.  Capture does not wait for slow storage.
+    # ready(record) is called for each image once it is in the capture directory.
+    # With -ingestwidth images are resized in the staging directory before they are added.
+    maxage = 120  # seconds an image is held before its batch is written
+
+    def __init__(self, stagedir, limit, ready, logger):
+        self.stagedir = stagedir
+        self.limit = limit  # bytes
+        self.ready = ready
+        self.logger = logger
+        self.pending = []  # (staged file, capture file, record, time added) - oldest first
+        self.bytes = 0
+        self.written = 0
+        self.batches = 0
+        self.lock = threading.Lock()  # pending
+        self.flushlock = threading.Lock()  # one batch at a time
+        self.wake = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def path(self, name):
+        return os.path.join(self.stagedir, name)
+
+    def full(self):
+        return self.bytes >= self.limit
+
+    def first(self, cameraname):
+        # The lowest frame number not yet written - or None
+        with self.lock:
+            numbers = [record['n'] for _, _, record, _ in self.pending if record['c'] == cameraname]
+        return min(numbers) if numbers else None
+
+    def add(self, staged, final, record):
+        with self.lock:
+            self.pending.append((staged, final, record, time.monotonic()))
+            self.bytes += record['b']
+            due = self.bytes >= self.limit / 2
+        if due:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(10)
+            self.wake.clear()
+            with self.lock:
+                due = self.pending and (self.bytes >= self.limit / 2 or time.monotonic() - self.pending[0][3] >= self.maxage)
+            if due:
+                self.flush()
+
+    def flush(self):
+        with self.flushlock:
+            with self.lock:
+                batch = list(self.pending)
+            if not batch:
+                return
+            start = time.perf_counter()
+            landed = []
+            written = []
+            for staged, final, record, _ in batch:
+                try:
+                    with open(staged, 'rb') as src, open(final, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1048576)
+                    written.append((final, record))
+                except OSError as e:  # e.g. the capture directory was deleted
+                    self.logger.info('Could not write staged image ' + final + ' ' + str(e))
+            # Only the batch is flushed - once the writes are queued the kernel can merge them
+            for final, record in written:
+                try:
+                    with open(final, 'rb+') as f:
+                        os.fsync(f.fileno())
+                    landed.append(record)
+                except OSError as e:
+                    self.logger.info('Could not write staged image ' + final + ' ' + str(e))
+            if os.name != 'nt':  # the new directory entries (Windows cannot open a directory)
+                for directory in set(os.path.dirname(final) for final, _ in written):
+                    try:
+                        fd = os.open(directory, os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    except OSError:
+                        pass
+            for staged, _, _, _ in batch:
+                try:
+                    os.remove(staged)
+                except OSError:
+                    pass
+            with self.lock:
+                del self.pending[:len(batch)]
+                self.bytes -= sum(record['b'] for _, _, record, _ in batch)
+            self.written += len(landed)
+            self.batches += 1
+            self.logger.debug('Wrote ' + str(len(landed)) + ' staged images in ' + str(round((time.perf_counter() - start) * 1000)) + ' ms')
+            for record in landed:
+                self.ready(record)
+
+    def discard(self):
+        # The capture directory is being deleted
+        with self.flushlock:
+            with self.lock:
+                for staged, _, _, _ in self.pending:
+                    try:
+                        os.remove(staged)
+                    except OSError:
+                        pass
+                self.pending = []
+                self.bytes = 0
+
+    def close(self):
+        if self.pending:
+            self.logger.info('Writing ' + str(len(self.pending)) + ' staged images')
+        self.flush()
+
+    def status(self):
+        return ('Staged images: ' + str(len(self.pending)) + ' (' + str(self.bytes // 1048576) + ' MB of '
+                + str(self.limit // 1048576) + ' MB), ' + str(self.written) + ' written in ' + str(self.batches) + ' batches')
+
+
+class FrameIngest:
+    # Processes each image (e.g. resizes it) in a pool of worker threads as it is captured.
+    # process(record, framefile) returns the updated record, which is then passed to ready(record)
+    # - or the ready given to add.  If process fails the image is passed on unchanged.
+    def __init__(self, workers, process, ready, logger):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self.process = process
+        self.ready = ready
+        self.logger = logger
+        self.pending = {}  # (cameraname, number) : record
+        self.done = 0
+        self.saved = 0  # bytes
+        self.settled = threading.Condition()
+
+    def add(self, record, framefile, ready=None):
+        with self.settled:
+            self.pending[(record['c'], record['n'])] = record
+        self.pool.submit(self.run, record, framefile, ready or self.ready)
+
+    def run(self, record, framefile, ready):
+        before = record['b']
+        try:
+            record = self.process(record, framefile)
+        except Exception as e:
+            self.logger.info('Could not process frame ' + str(record['n']) + ' ' + str(e))
+        try:
+            ready(record)
+        finally:
+            with self.settled:
+                self.pending.pop((record['c'], record['n']), None)
+                self.done += 1
+                self.saved += before - record['b']
+                self.settled.notify_all()
+
+    def first(self, cameraname):
+        # The lowest frame number still being processed - or None
+        with self.settled:
+            numbers = [number for camera, number in self.pending if camera == cameraname]
+        return min(numbers) if numbers else None
+
+    def flush(self):
+        # Waits for every image to be processed
+        with self.settled:
+            while self.pending:
+                self.settled.wait(1)
+
+    def status(self):
+        return ('Resizing images: ' + str(len(self.pending)) + ' waiting, ' + str(self.done) + ' done, '
+                + str(max(0, self.saved) // 1048576) + ' MB saved')
+
+
+class JobIndex:
+    # Append-only history of the capture sets under basedir - shared by every DuetLapse3 on
+    # the computer and read by startDuetLapse3.  Each json line changes one capture set:
+    # d directory (relative to basedir) and any of job, printer, pid, session, start, end,
+    # frames {camera: count}, bytes (of the images), gone (images deleted - null if back) and
+    # v {video: {b bytes, s encode seconds}} where a video of null has been deleted.
+    filename = 'jobs.jsonl'
+
+    def __init__(self, basedir, logger):
+        self.basedir = basedir
+        self.path = os.path.join(basedir, self.filename)
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.sets = {}  # d : capture set
+        self.offset = 0  # bytes of the index already read
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def key(self, path):
+        return os.path.relpath(path.rstrip('/\\'), self.basedir).replace('\\', '/')
+
+    def update(self, directory, **fields):
+        fields['d'] = self.key(directory)
+        with self.lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(fields, separators=(',', ':')) + '\n')
+            except OSError as e:
+                self.logger.debug('Could not update the job index ' + str(e))
+
+    def video(self, directory, videofile, seconds):
+        try:
+            size = os.path.getsize(videofile)
+        except OSError:
+            return
+        self.update(directory, v={self.key(videofile): {'b': size, 's': round(seconds, 1)}})
+
+    def removed(self, path):
+        # A capture directory or a video was deleted
+        key = self.key(path)
+        for captureset in self.capturesets():
+            if captureset['d'] == key:
+                self.update(path, gone=round(time.time()))
+            elif key in captureset.get('v', {}):
+                self.update(os.path.join(self.basedir, captureset['d']), v={key: None})
+
+    def capturesets(self):
+        # Capture sets - oldest first.  Only lines added since the last call are read.
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except OSError:
+                data = b''
+            end = data.rfind(b'\n') + 1  # a partly written line is read next time
+            self.offset += end
+            for line in data[:end].splitlines():
+                try:
+                    fields = json.loads(line)
+                    captureset = self.sets.setdefault(fields['d'], {'d': fields['d'], 'v': {}})
+                except (ValueError, KeyError, TypeError):
+                    continue
+                for name, value in fields.items():
+                    if name != 'v':
+                        captureset[name] = value
+                        continue
+                    for video, details in value.items():
+                        if details is None:
+                            captureset['v'].pop(video, None)
+                        else:
+                            captureset['v'][video] = details
+            return sorted((dict(captureset, v=dict(captureset['v'])) for captureset in self.sets.values()),
+                          key=lambda c: c.get('start', 0))
+
+    @classmethod
+    def find(cls, directory, logger):
+        # The index of the basedir that directory is in - startDuetLapse3 may be given a
+        # topdir below the basedir of the DuetLapse3 instances it starts
+        path = os.path.abspath(directory)
+        while True:
+            if os.path.isfile(os.path.join(path, cls.filename)):
+                return cls(path, logger)
+            parent = os.path.dirname(path)
+            if parent == path:
+                return cls(directory, logger)
+            path = parent
+
+    def within(self, directory):
+        # Capture sets under directory
+        top = self.key(os.path.abspath(directory))
+        return [captureset for captureset in self.capturesets()
+                if top == '.' or captureset['d'] == top or captureset['d'].startswith(top + '/')]
+
+    def seed(self):
+        # Capture directories made before there was an index
+        self.reconcile(self.basedir)
+
+    def reconcile(self, directory):
+        # Brings the index into line with the capture directories under directory - adds
+        # any that are missing (made before the index or by an older version) and marks
+        # those no longer on disk as gone
+        known = {captureset['d']: captureset for captureset in self.within(directory)}
+        found = set()
+        for thisdir, subdirs, files in os.walk(directory):
+            subdirs[:] = [subdir for subdir in subdirs if subdir != 'originals']
+            if subdirs or not any(file.endswith('.jpeg') for file in files):
+                continue
+            key = self.key(thisdir)
+            found.add(key)
+            if key not in known:
+                self.add(thisdir)
+            elif known[key].get('gone'):
+                self.update(thisdir, gone=None)
+        for key, captureset in known.items():
+            thisdir = os.path.join(self.basedir, os.path.normpath(key))
+            if key not in found and not captureset.get('gone') and not os.path.isdir(thisdir):
+                self.update(thisdir, gone=round(time.time()))
+
+    def add(self, thisdir):
+        frames = FrameManifest(thisdir).frames()
+        name = os.path.basename(thisdir)
+        try:
+            start = round(os.path.getmtime(thisdir))
+        except OSError:
+            start = 0
+        fields = {'start': start, 'pid': name.split('_', 1)[0].split('-', 1)[0],
+                  'frames': {cameraname: len(records) for cameraname, records in frames.items()}}
+        if '_' in name:
+            fields['job'] = name.split('_', 1)[1]
+        parent = os.path.dirname(thisdir)
+        fields['printer'] = os.path.basename(parent)
+        self.update(thisdir, **fields)
+        for video in os.listdir(parent):
+            if video.startswith(name + '_') and video.endswith('.mp4') and '_proxy' not in video:
+                self.video(thisdir, os.path.join(parent, video), 0)
+
+
+class FrameArchive:
+    # Uncompressed zip of a capture directory.  Each image is added as it is stored so the
+    # archive is ready as soon as the capture ends - without reading the images again.
+    # Written as [directory].zip.part until close() adds the central directory.
+    def __init__(self, directory, logger):
+        self.directory = os.path.normpath(directory)
+        self.path = self.directory + '.zip'
+        self.part = self.path + '.part'
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.archive = None
+        self.count = 0
+
+    def add(self, path):
+        with self.lock:
+            try:
+                if self.archive is None:
+                    self.archive = zipfile.ZipFile(self.part, 'w', zipfile.ZIP_STORED)
+                self.archive.write(path, os.path.relpath(path, os.path.dirname(self.directory)))
+                self.count += 1
+            except (OSError, ValueError) as e:
+                self.logger.debug('Could not add ' + path + ' to ' + self.part + ' ' + str(e))
+
+    def backfill(self, frames):
+        # Images that are already in the directory e.g. when resuming
+        for cameraname, records in sorted(frames.items()):
+            for number in sorted(records):
+                self.add(os.path.join(self.directory, cameraname + '_' + str(number).zfill(8) + '.jpeg'))
+
+    def close(self):
+        with self.lock:
+            if self.archive is None:
+                return
+            try:
+                manifestfile = os.path.join(self.directory, FrameManifest.filename)
+                if os.path.isfile(manifestfile):
+                    self.archive.write(manifestfile, os.path.relpath(manifestfile, os.path.dirname(self.directory)))
+                self.archive.close()
+                os.replace(self.part, self.path)
+                self.logger.info('Zip file of ' + str(self.count) + ' images is in ' + self.path)
+            except (OSError, ValueError) as e:
+                self.logger.info('Could not complete ' + self.path + ' ' + str(e))
+            self.archive = None
+
+    def discard(self):
+        with self.lock:
+            if self.archive is None:
+                return
+            try:
+                self.archive.close()
+                os.remove(self.part)
+            except (OSError, ValueError):
+                pass
+            self.archive = None
+
+
+class DirectoryCache:
+    # Directory listings for the file browser kept in memory so that a page view does not list
+    # every directory under topdir.  On Linux, inotify drops a listing when its directory changes.
+    # Elsewhere a listing is used while the directory modification time is unchanged.
+    events = 0x100 | 0x200 | 0x40 | 0x80 | 0x400 | 0x800  # create, delete, moved from / to, delete / move self
+    settle = 2  # seconds - a directory changed more recently may change again within its mtime resolution
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.listings = {}  # path : (mtime_ns, [(name, isdir, islink)])
+        self.summaries = {}  # path : {'empty', 'jpeg', 'subdirs'}
+        self.manifests = {}  # path : FrameManifest - read incrementally
+        self.watches = {}  # inotify watch descriptor : path
+        self.watched = {}  # path : watch descriptor
+        self.generations = {}  # path : changes seen - a listing made while it changed is not kept
+        self.overflows = 0  # queue overflows - every listing made while one happened is not kept
+        self.hits = 0
+        self.misses = 0
+        self.inotify = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                self.inotify = fd
+                threading.Thread(target=self.watch, daemon=True).start()
+        except (OSError, AttributeError, TypeError):
+            pass  # not Linux - modification times are used
+        self.logger.debug('Directory cache using ' + ('inotify' if self.inotify is not None else 'modification times'))
+
+    def watch(self):  # Run as a thread
+        while True:
+            try:
+                data = os.read(self.inotify, 65536)
+            except OSError:
+                return
+            offset = 0
+            with self.lock:
+                while offset + 16 <= len(data):
+                    wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+                    offset += 16 + length
+                    if mask & 0x4000:  # queue overflow - changes were missed
+                        self.listings.clear()
+                        self.summaries.clear()
+                        self.overflows += 1
+                        continue
+                    path = self.watches.get(wd)
+                    if path is None:
+                        continue
+                    self.generations[path] = self.generations.get(path, 0) + 1  # kept - see entries
+                    self.listings.pop(path, None)
+                    self.summaries.pop(path, None)
+                    if mask & (0x400 | 0x800 | 0x8000):  # deleted, moved away or watch removed
+                        # The path may be made again (e.g. a resumed directory renamed back) - it is
+                        # watched afresh when it is next listed
+                        del self.watches[wd]
+                        if self.watched.get(path) == wd:
+                            del self.watched[path]
+                        self.manifests.pop(path, None)
+                        if not mask & 0x8000:  # the kernel has not removed it yet
+                            self.libc.inotify_rm_watch(self.inotify, wd)
+
+    def add_watch(self, path):
+        # Called with lock held
+        if self.inotify is None or path in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.inotify, os.fsencode(path), self.events)
+        if wd >= 0:
+            self.watches[wd] = path
+            self.watched[path] = wd
+
+    def current(self, path, mtime):
+        # Called with lock held - True if the cached listing of path can be used
+        if path not in self.listings:
+            return False
+        if path in self.watched:
+            return True
+        return self.listings[path][0] == mtime and time.time() - mtime / 1e9 > self.settle
+
+    def entries(self, path):
+        # [(name, isdir, islink)] of path or None if it cannot be listed
+        path = os.path.normpath(path)
+        with self.lock:
+            watched = path in self.watched
+        try:
+            mtime = 0 if watched else os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            if self.current(path, mtime):
+                self.hits += 1
+                return self.listings[path][1]
+        try:
+            if watched:
+                mtime = os.stat(path).st_mtime_ns
+            with self.lock:
+                self.add_watch(path)  # before listing so no change is missed
+                generation = (self.generations.get(path, 0), self.overflows)
+            listing = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        listing.append((entry.name, entry.is_dir(), entry.is_symlink()))
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        listing.sort(key=lambda entry: entry[0].lower())
+        with self.lock:
+            self.misses += 1
+            if generation == (self.generations.get(path, 0), self.overflows):  # else it changed while listed
+                self.listings[path] = (mtime, listing)
+        return listing
+
+    def summary(self, path):
+        # What the file browser needs to know about a directory without showing it
+        path = os.path.normpath(path)
+        listing = self.entries(path)
+        if listing is None:
+            return {'empty': False, 'jpeg': False, 'subdirs': True}
+        with self.lock:
+            if path in self.summaries and self.listings.get(path, (0, None))[1] is listing:
+                return self.summaries[path]
+        summary = {'empty': not listing,
+                   'jpeg': any(name.lower().endswith('.jpeg') for name, isdir, _ in listing if not isdir),
+                   'subdirs': any(isdir and name != 'originals' for name, isdir, _ in listing)}  # -keeporiginal
+        with self.lock:
+            if self.listings.get(path, (0, None))[1] is listing:  # not changed since
+                self.summaries[path] = summary
+        return summary
+
+    def classify(self, path, deletablefiles):
+        # Capture directories (bottom level with images) and deletable entries of path.
+        # Directories end with a separator.
+        path = os.path.normpath(path)
+        jpegfolders = []
+        deletable = []
+        for name, isdir, _ in self.entries(path) or []:
+            fullname = os.path.join(path, name)
+            if isdir:
+                summary = self.summary(fullname)
+                if summary['empty']:
+                    deletable.append(os.path.join(fullname, ''))
+                elif summary['jpeg'] and not summary['subdirs']:
+                    jpegfolders.append(os.path.join(fullname, ''))
+                    deletable.append(os.path.join(fullname, ''))
+            elif any(ext in name for ext in deletablefiles):
+                deletable.append(fullname)
+        return jpegfolders, deletable
+
+    def manifest(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            manifest = self.manifests.get(path)
+            try:
+                replaced = manifest is not None and os.path.getsize(manifest.path) < manifest.offset
+            except OSError:
+                replaced = True  # e.g. the directory was deleted and made again
+            if manifest is None or replaced:
+                manifest = self.manifests[path] = FrameManifest(path)
+            return manifest
+
+
+class Storage:
+    # Native file system operations in place of mkdir / rm / rmdir / del shell commands.
+    # Like runsubprocess, each operation returns True or False.
+    # Details of the most recent failure are kept in lasterror.
+    def __init__(self, logger):
+        self.logger = logger
+        self.lasterror = {}
+
+    def done(self, operation, path, start, error=None):
+        elapsed = time.perf_counter() - start
+        if error is None:
+            self.logger.debug('Storage ' + operation + ' ' + path + ' ' + str(round(elapsed * 1000, 1)) + ' ms')
+            return True
+        self.lasterror = {'operation': operation, 'path': path, 'errno': getattr(error, 'errno', None),
+                          'error': getattr(error, 'strerror', None) or str(error), 'seconds': elapsed}
+        self.logger.debug('Storage ' + operation + ' failed: ' + str(self.lasterror))
+        return False
+
+    def makedirs(self, path):
+        start = time.perf_counter()
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            return self.done('makedirs', path, start, e)
+        return self.done('makedirs', path, start)
+
+    def rmtree(self, path):
+        # A directory that is already gone is not an error
+        start = time.perf_counter()
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return self.done('rmtree', path, start, e)
+        return self.done('rmtree', path, start)
+
+    def remove(self, path):
+        # Removes a file or a directory tree
+        if os.path.isdir(path) and not os.path.islink(path):
+            return self.rmtree(path)
+        start = time.perf_counter()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return self.done('remove', path, start, e)
+        return self.done('remove', path, start)
+
+    def deleteglob(self, directory, pattern):
+        # Removes the files in directory that match pattern e.g. *.log
+        start = time.perf_counter()
+        error = None
+        for name in fnmatch.filter(os.listdir(directory) if os.path.isdir(directory) else [], pattern):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                error = e  # keep going - report the last failure
+        return self.done('deleteglob', os.path.join(directory, pattern), start, error)
+
+class Retention:
+    # Keeps topdir within a quota (bytes) and the disk above a minimum of free space (bytes).
+    # Frames of finished jobs (with their zip) are evicted first (oldest first) and then videos
+    # (oldest first).  Directories that can still be resumed are kept.
+    # Usage is counted as files (images, zips, videos) are added and removed.  topdir is rescanned
+    # every few minutes in the background - the capture thread never waits for it.
+    rescan = 600  # seconds
+    slack = 0.9  # evict until 10% below the limits so eviction does not run on every capture
+
+    def __init__(self, topdir, quota, minfree, storage, logger, index=None):
+        self.topdir = topdir
+        self.quota = quota
+        self.minfree = minfree
+        self.storage = storage
+        self.logger = logger
+        self.index = index  # JobIndex told about evictions
+        self.lock = threading.Lock()
+        self.decisions = []  # (time, text) newest last
+        self.usage = 0
+        self.scanned = 0
+        self.scanner = None  # background rescan
+
+    def active(self):
+        return self.quota > 0 or self.minfree > 0
+
+    def size(self, path):
+        if not os.path.isdir(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        total = 0
+        for thisdir, _, files in os.walk(path):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(thisdir, file))
+                except OSError:
+                    pass
+        return total
+
+    def scan(self):
+        self.usage = self.size(self.topdir)
+        self.scanned = time.time()
+
+    def add(self, size):
+        self.usage += size
+
+    def added(self, *paths):
+        # Files written other than images e.g. videos
+        for path in paths:
+            try:
+                self.usage += os.path.getsize(path)
+            except OSError:
+                pass
+
+    def free(self):
+        try:
+            return shutil.disk_usage(self.topdir).free
+        except OSError:
+            return 0
+
+    def over(self, slack=1.0):
+        if not self.active():
+            return False
+        if self.scanned == 0:
+            self.scan()  # first use - there is no count yet
+        elif time.time() - self.scanned > self.rescan and (self.scanner is None or not self.scanner.is_alive()):
+            self.scanner = threading.Thread(target=self.scan, daemon=True)  # picks up files written by other instances
+            self.scanner.start()
+        if self.quota > 0 and self.usage > self.quota * slack:
+            return True
+        return self.minfree > 0 and self.free() < self.minfree / slack
+
+    def decide(self, text):
+        if self.decisions and self.decisions[-1][1] == text:
+            return  # already reported
+        self.decisions = self.decisions[-9:] + [(time.time(), text)]
+        self.logger.info('Retention: ' + text)
+
+    def candidates(self, running, keep):
+        # Frame directories of jobs that are no longer running (other than those in keep), then videos - oldest first
+        keep = [os.path.normpath(path) for path in keep]
+        dirs = []
+        videos = []
+        try:
+            entries = list(os.scandir(self.topdir))
+        except OSError:
+            return []
+        for entry in entries:
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.is_dir():
+                if entry.name.split('_', 1)[0].split('-', 1)[0] in running or os.path.normpath(entry.path) in keep:
+                    continue
+                dirs.append((mtime, entry.path))
+            elif entry.name.endswith('.mp4') and not entry.name.endswith('_proxy.mp4'):
+                videos.append((mtime, entry.path))
+        return [path for _, path in sorted(dirs)] + [path for _, path in sorted(videos)]
+
+    def enforce(self, running, keep):
+        # Returns True if the limits are met - after evicting as much as needed
+        with self.lock:
+            if not self.over():
+                return True
+            for path in self.candidates(running, keep):
+                if not self.over(self.slack):
+                    break
+                paths = [path]
+                if path.endswith('.mp4'):  # The preview and poster belong to the video
+                    paths = paths + [path[:-len('.mp4')] + '_proxy.mp4', path[:-len('.mp4')] + '_poster.jpg']
+                else:  # as does the zip to the images
+                    paths = paths + [path + '.zip', path + '.zip.part']
+                freed = 0
+                for thispath in paths:
+                    size = self.size(thispath)
+                    if os.path.exists(thispath) and self.storage.remove(thispath):
+                        freed += size
+                self.usage = max(0, self.usage - freed)
+                if self.index is not None:
+                    self.index.removed(path)
+                self.decide('evicted ' + os.path.basename(path) + ' (' + str(freed // 1048576) + ' MB)')
+            if self.over():
+                self.decide('not enough space - capture refused')
+                return False
+            return True
+
+    def status(self):
+        lines = []
+        if self.quota > 0:
+            lines.append('Disk usage: ' + str(self.usage // 1048576) + ' MB of ' + str(self.quota // 1048576) + ' MB quota')
+        if self.minfree > 0:
+            lines.append('Disk free: ' + str(self.free() // 1048576) + ' MB (minimum ' + str(self.minfree // 1048576) + ' MB)')
+        for when, text in self.decisions[-3:]:
+            lines.append(time.strftime('%H:%M', time.localtime(when)) + ' ' + text)
+        return lines
+
+class JobRunner:
+    # Runs long web UI operations (e.g. video, delete) in a bounded pool of worker threads
+    # so that request threads return at once.  Each job has an id, state (queued, running,
+    # completed or failed), progress and result.  A request for the same work as an unfinished
+    # job is given that job instead of starting the work again.
+    keep = 20  # finished jobs remembered
+
+    def __init__(self, workers, logger):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.jobs = {}  # id : job - oldest first
+        self.futures = {}  # id : future
+        self.progress = {}  # id : function returning the progress text of a running job
+        self.nextid = 1
+
+    def submit(self, kind, target, function, args=(), progress=None):
+        # Returns the job id and True if a new job was started
+        key = kind + ' ' + target
+        with self.lock:
+            for job in self.jobs.values():
+                if job['key'] == key and job['state'] in ['queued', 'running']:
+                    return job['id'], False
+            job = {'id': self.nextid, 'key': key, 'kind': kind, 'target': target, 'state': 'queued',
+                   'progress': '', 'result': '', 'submitted': time.time(), 'started': 0, 'finished': 0}
+            self.nextid += 1
+            self.jobs[job['id']] = job
+            if progress is not None:
+                self.progress[job['id']] = progress
+            self.prune()
+        self.logger.info('Job ' + str(job['id']) + ' queued: ' + key)
+        self.futures[job['id']] = self.pool.submit(self.run, job, function, args)
+        return job['id'], True
+
+    def run(self, job, function, args):
+        job['state'] = 'running'
+        job['started'] = time.time()
+        try:
+            result = function(*args)
+            job['result'] = '' if result is None or result is True else str(result)
+            job['state'] = 'failed' if result is False else 'completed'
+        except Exception as e:
+            job['result'] = str(e)
+            job['state'] = 'failed'
+        job['finished'] = time.time()
+        self.logger.info('Job ' + str(job['id']) + ' ' + job['state'] + ': ' + job['key'])
+
+    def wait(self, jobid, timeout):
+        # Gives quick jobs (e.g. most deletes) the chance to finish before a page is shown
+        future = self.futures.get(jobid)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                pass
+        return self.jobs[jobid]['state']
+
+    def prune(self):
+        finished = [jobid for jobid, job in self.jobs.items() if job['state'] in ['completed', 'failed']]
+        for jobid in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[jobid]
+            self.futures.pop(jobid, None)
+            self.progress.pop(jobid, None)
+
+    def list(self):
+        jobs = []
+        with self.lock:
+            for jobid, job in self.jobs.items():
+                job = dict(job)
+                del job['key']
+                if job['state'] == 'running' and jobid in self.progress:
+                    try:
+                        job['progress'] = self.progress[jobid]()
+                    except Exception:
+                        pass
+                jobs.append(job)
+        return jobs
+
+    def status(self):
+        # One line for each unfinished job and the most recent finished jobs
+        lines = []
+        jobs = self.list()
+        finished = [job for job in jobs if job['state'] in ['completed', 'failed']][-3:]
+        for job in jobs:
+            if job['state'] in ['queued', 'running'] or job in finished:
+                line = 'Job ' + str(job['id']) + ' ' + job['kind'] + ' ' + os.path.basename(job['target'].rstrip('/\\'))
+                line = line + ': ' + job['state']
+                if job['progress'] != '':
+                    line = line + ' - ' + job['progress']
+                lines.append(line)
+        return lines
+
+class EncodeQueue:
+    # Host wide first-in first-out queue for ffmpeg encodes.
+    # Shared by every DuetLapse3 and startDuetLapse3 process through ticket files in queuedir.
+    # Ticket names ([time]-[pid]-[process start]-[thread]) sort in arrival order. The first [limit]
+    # live tickets may run ffmpeg.  The process start time tells a reused pid from the ticket's owner.
+    def __init__(self, limit, logger, queuedir=''):
+        self.limit = max(1, limit)
+        self.logger = logger
+        if queuedir == '':
+            queuedir = os.path.join(tempfile.gettempdir(), 'DuetLapse3-encode')
+        self.queuedir = queuedir
+        try:
+            if not os.path.isdir(queuedir):
+                os.makedirs(queuedir, exist_ok=True)
+                os.chmod(queuedir, 0o1777)  # every user on the host queues here - sticky like /tmp
+        except OSError as e:
+            self.logger.info('Could not create the encode queue ' + queuedir + ' ' + str(e))
+        self.released = threading.Condition()
+        self.positions = {}  # ticket : (label, place in the queue) for encodes waiting in this process
+        self.started = str(int(psutil.Process().create_time() * 100))
+
+    @contextlib.contextmanager
+    def slot(self, label):
+        ticket = self.acquire(label)
+        try:
+            yield
+        finally:
+            self.release(ticket, label)
+
+    def acquire(self, label):
+        # Returns the ticket - or None if the queue cannot be used and ffmpeg runs without waiting
+        name = (str(time.time_ns()).zfill(20) + '-' + str(os.getpid()) + '-' + self.started + '-'
+                + str(threading.get_ident()) + '.ticket')
+        ticket = os.path.join(self.queuedir, name)
+        try:
+            with open(ticket, 'w') as f:
+                f.write(label)
+        except OSError as e:  # e.g. made by another user without write permission for us
+            self.logger.info(label + ': could not join the encode queue - running ffmpeg without it ' + str(e))
+            return None
+        lastposition = -1
+        while True:
+            position = self.position(name) - self.limit + 1
+            if position <= 0:
+                break
+            self.positions[name] = (label, position)
+            if position != lastposition:
+                self.logger.info(label + ': waiting for ffmpeg - position ' + str(position) + ' in the encode queue')
+                lastposition = position
+            with self.released:  # Releases in this process wake us at once - other processes are polled
+                self.released.wait(1)
+        self.positions.pop(name, None)
+        self.logger.debug(label + ': ffmpeg slot acquired')
+        return ticket
+
+    def release(self, ticket, label):
+        if ticket is None:  # ran without the queue
+            return
+        try:
+            os.remove(ticket)
+        except OSError:
+            pass
+        self.logger.debug(label + ': ffmpeg slot released')
+        with self.released:
+            self.released.notify_all()
+
+    def tickets(self):
+        # Live tickets in arrival order - tickets left by processes that no longer exist are removed
+        live = []
+        try:
+            names = sorted(name for name in os.listdir(self.queuedir) if name.endswith('.ticket'))
+        except OSError:
+            return live
+        for name in names:
+            fields = name[:-len('.ticket')].split('-')
+            try:
+                ticketpid = int(fields[1])
+                started = int(fields[2]) if len(fields) > 3 else None  # older tickets have no start time
+            except (IndexError, ValueError):
+                continue
+            if not self.alive(ticketpid, started):
+                try:
+                    os.remove(os.path.join(self.queuedir, name))
+                except OSError:
+                    pass
+                continue
+            live.append(name)
+        return live
+
+    def alive(self, ticketpid, started):
+        try:
+            created = psutil.Process(ticketpid).create_time()
+        except psutil.Error:
+            return False
+        return started is None or abs(created * 100 - started) <= 100  # a second for rounding
+
+    def position(self, name):
+        live = self.tickets()
+        if name in live:
+            return live.index(name)
+        return 0  # Our ticket has gone - do not wait forever
+
+    def waiting(self):
+        # Labels of every encode on this host - running first, then waiting in order
+        labels = []
+        for name in self.tickets():
+            try:
+                with open(os.path.join(self.queuedir, name)) as f:
+                    labels.append(f.read())
+            except OSError:
+                pass
+        return labels[:self.limit], labels[self.limit:]
+
+
 def getRunningInstancePids():
     pidlist = []
     for p in psutil.process_iter():
@@ -754,7 +2784,7 @@ def getPidDirs():
 
 
 def createWorkingDir(baseworkingdir):
-    global workingdir_exists, workingdir
+    global workingdir_exists, workingdir, manifest, archive
     jobname = getDuetJobname(apiModel)
     if jobname != '':
         _, jobname = os.path.split(jobname)  # get the filename less any path
@@ -762,22 +2792,98 @@ def createWorkingDir(baseworkingdir):
         jobname = jobname.replace('.gcode', '')  # get rid of the extension
         jobname = jobname.replace(':', u'\u02f8')  # replace any colons
         workingdir = baseworkingdir + '_' + jobname
+        if resume and adoptSession(jobname):
+            return workingdir
     else:
         workingdir = baseworkingdir
 
-    if win:
-        cmd = 'mkdir "' + workingdir + '"' + debug
-    else:
-        cmd = 'mkdir -p "' + workingdir + '"' + debug
-
-    if runsubprocess(cmd) is False:
+    if storage.makedirs(workingdir) is False:
         logger.debug('Could not create working directory ' + workingdir)
     else:
         workingdir_exists = True
+        manifest = FrameManifest(workingdir)
+        if livezip:
+            archive = FrameArchive(workingdir, logger)
+        jobindex.update(workingdir, job=jobname, printer=duetname, pid=pid, session=session, start=round(time.time()))
 
     return workingdir
 
 
+def stateName(statepid):
+    return os.path.join(topdir, str(statepid) + '.state')
+
+def saveState():
+    # Checkpoint of the capture state - written after every capture so that -resume can continue after a crash
+    state = {'pid': pid, 'job': sessionJob(workingdir), 'workingdir': workingdir, 'session': session,
+             'frame1': frame1, 'frame2': frame2, 'zo1': zo1, 'zo2': zo2, 'action': action, 'time': time.time()}
+    statefile = stateName(pid)
+    try:
+        with open(statefile + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(statefile + '.tmp', statefile)  # never leaves a partly written checkpoint
+    except OSError as e:
+        logger.debug('Could not save state ' + str(e))
+
+def orphanStates(pidlist):
+    # Checkpoints of instances that are no longer running - newest first
+    orphans = []
+    try:
+        names = os.listdir(topdir)
+    except OSError:
+        return orphans
+    for name in names:
+        if not name.endswith('.state') or name[:-len('.state')] in pidlist:
+            continue
+        try:
+            with open(os.path.join(topdir, name)) as f:
+                state = json.load(f)
+            if str(state['pid']) + '.state' == name and 'workingdir' in state:
+                orphans.append(state)
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+    orphans.sort(key=lambda state: state.get('time', 0), reverse=True)
+    return orphans
+
+def adoptSession(job):
+    # Continues the images of an instance that stopped without terminating and was following the same job.
+    # Its directory is renamed for this instance and the frame numbers carry on from its checkpoint.
+    global workingdir, workingdir_exists, manifest, archive, frame1, frame2, zo1, zo2, session
+    for state in orphanStates(getRunningInstancePids()):
+        if state.get('job') != job or not os.path.isdir(state['workingdir']):
+            continue
+        newdir = baseworkingdir + '_' + job
+        try:
+            os.rename(state['workingdir'], newdir)
+        except OSError as e:
+            logger.info('Could not resume ' + state['workingdir'] + ' ' + str(e))
+            continue
+        storage.remove(stateName(state['pid']))
+        jobindex.update(state['workingdir'], gone=round(time.time()))
+        jobindex.update(newdir, job=job, printer=duetname, pid=pid, session=state.get('session', session),
+                        start=round(state.get('time', time.time())))
+        workingdir = newdir
+        workingdir_exists = True
+        storage.deleteglob(workingdir, '*_segment_*.mp4')  # segments of the stopped instance are not this run's
+        manifest = FrameManifest(workingdir)
+        if livezip:  # the archive of the stopped instance was never completed
+            storage.remove(os.path.normpath(state['workingdir']) + '.zip.part')
+            archive = FrameArchive(workingdir, logger)
+            archive.backfill(manifest.frames())
+        frame1 = state.get('frame1', 0)
+        frame2 = state.get('frame2', 0)
+        zo1 = state.get('zo1', -1)
+        zo2 = state.get('zo2', -1)
+        session = state.get('session', session)  # still the same session of the job
+        logger.info('')
+        logger.info('##########################################################')
+        logger.info('Resumed ' + job + ' from process ' + str(state['pid']))
+        logger.info('Continuing from frame ' + str(frame1) + ' (Camera1) and ' + str(frame2) + ' (Camera2)')
+        logger.info('##########################################################')
+        logger.info('')
+        saveState()
+        return True
+    return False
+
 def cleanupFiles(phase):
     global workingdir_exists, keepfiles
     logger.info('Cleaning up phase:  ' + phase)
@@ -791,58 +2897,58 @@ def cleanupFiles(phase):
 
     if phase == 'startup':
         if keepfiles: return
-        if win:
-            for dirs in dirlist:
-                split_dirs = dirs.split("-", 1)
-                dirpid = split_dirs[0]
-                if dirpid not in pidlist:
-                    cmd = 'rmdir "' + topdir + '\\' + dirs + '" /s /q' + debug
-                    if runsubprocess(cmd) is False:
-                        logger.debug('Could not clean up ' + dirs)
-
-            if (not keeplogs) and (len(pidlist) == 1):  # only delete logs if no other processes running
-                #  Note position of last " so that shell expands *.log portion
-                cmd = 'del /q "' + topdir + '\\"*.log' + debug
-                if runsubprocess(cmd) is False:
-                    logger.debug('Could not clean up log files')
-        else:
-            for dirs in dirlist:
-                split_dirs = dirs.split("-", 1)
-                dirpid = split_dirs[0]
-                if dirpid not in pidlist:
-                    cmd = 'rm -rf "' + topdir + '/' + dirs + '"' + debug
-                    if runsubprocess(cmd) is False:
-                        logger.debug('Could not clean up ' + dirs)
-
-            if (not keeplogs) and (len(pidlist) == 1):  # only delete logs if no other processes running
-                # Note position of last " so that shell expands *.log portion
-                cmd = 'rm -f "' + topdir + '/"*.log' + debug
-                if runsubprocess(cmd) is False:
-                    logger.debug('Could not clean up log files')
+        orphans = orphanStates(pidlist)
+        keepdirs = [os.path.basename(state['workingdir']) for state in orphans] if resume else []
+        for dirs in dirlist:
+            dirpid = dirs.split('_', 1)[0].split('-', 1)[0]  # [pid]_[job]
+            if dirpid not in pidlist and dirs not in keepdirs:
+                if storage.rmtree(os.path.join(topdir, dirs)) is False:
+                    logger.debug('Could not clean up ' + dirs)
+                else:
+                    jobindex.removed(os.path.join(topdir, dirs))
+        for name in os.listdir(topdir) if not resume else []:  # -livezip archives that were never completed
+            if name.endswith('.zip.part') and name.split('_', 1)[0].split('-', 1)[0] not in pidlist:
+                storage.remove(os.path.join(topdir, name))
+        if not resume:
+            for state in orphans:
+                storage.remove(stateName(state['pid']))
+
+        if (not keeplogs) and (len(pidlist) == 1):  # only delete logs if no other processes running
+            if storage.deleteglob(topdir, '*.log') is False:
+                logger.debug('Could not clean up log files')
 
     elif (phase == 'standby') or (phase == 'restart'):  # delete images directory will be recreated on first capture
-        if workingdir_exists:
-            if win:
-                cmd = 'rmdir "' + workingdir + '" /s /q' + debug
+        storage.remove(stateName(pid))  # nothing left to resume
+        if ingest is not None:  # before the images are deleted
+            ingest.flush()
+        if writer is not None:
+            writer.discard()
+        if archive is not None:
+            if phase == 'restart':
+                archive.close()
             else:
-                cmd = 'rm -rf "' + workingdir + '"' + debug
-            if runsubprocess(cmd) is False:
+                archive.discard()
+        if workingdir_exists:
+            if storage.rmtree(workingdir) is False:
                 logger.debug('Could not delete ' + workingdir)
                 workingdir_exists = True
             else:
                 workingdir_exists = False
+                jobindex.update(workingdir, end=round(time.time()), gone=round(time.time()))
 
     elif phase == 'terminate':
+        storage.remove(stateName(pid))  # a finished capture set is not resumed
+        if workingdir_exists:
+            jobindex.update(workingdir, end=round(time.time()))
+        if archive is not None:  # ready before any images are deleted
+            archive.close()
         if keepfiles: return
 
         if deletepics:
-            if win:
-                cmd = 'rmdir "' + workingdir + '" /s /q' + debug
-            else:
-                cmd = 'rm -rf "' + workingdir + '"' + debug
-
-            if runsubprocess(cmd) is False:
+            if storage.rmtree(workingdir) is False:
                 logger.debug('Could not delete ' + workingdir)
+            elif workingdir_exists:
+                jobindex.removed(workingdir)
 
     return  # cleanupFiles
 
@@ -978,11 +3084,20 @@ def unPause():
     return
 
 
-def onePhoto(cameraname, camera, weburl, camparam):
+def onePhoto(cameraname, camera, weburl, camparam, trigger='final', layer=-1):
     global frame1, frame2, workingdir
-    if not workingdir_exists:
+    if not workingdir_exists or manifest is None:
         workingdir = createWorkingDir(baseworkingdir)  # created as late as possible - adds job fileName if available
 
+    if retention.over():
+        running = getRunningInstancePids()
+        keep = [workingdir] + ([state['workingdir'] for state in orphanStates(running)] if resume else [])  # -resume
+        if not retention.enforce(running, keep):
+            return  # Not enough disk space - see the status page
+
+    if trigger != 'final':
+        refreshZ()  # alongside the capture
+
     if cameraname == 'Camera1':
         frame1 += 1
         frame = frame1
@@ -991,10 +3106,13 @@ def onePhoto(cameraname, camera, weburl, camparam):
         frame = frame2
 
     s = str(frame).zfill(8)
-    if win:
-        fn = ' "' + workingdir + '\\' + cameraname + '_' + s + '.jpeg"'
+    framefile = os.path.join(workingdir, cameraname + '_' + s + '.jpeg')
+    staging = writer is not None and not writer.full()  # when full - written directly
+    if staging:
+        capturefile = writer.path(cameraname + '_' + s + '.jpeg')
     else:
-        fn = ' "' + workingdir + '/' + cameraname + '_' + s + '.jpeg"'
+        capturefile = framefile
+    fn = ' "' + capturefile + '"'
 
     if 'usb' in camera:
         cmd = 'fswebcam --quiet --no-banner ' + fn + debug
@@ -1013,6 +3131,7 @@ def onePhoto(cameraname, camera, weburl, camparam):
 
     global timePriorPhoto1, timePriorPhoto2
 
+    started = time.monotonic()
     if runsubprocess(cmd) is False:
         logger.info('!!!!!!!!!!!  There was a problem capturing an image !!!!!!!!!!!!!!!')
         # Decrement the frame counter because we did not capture anything
@@ -1029,6 +3148,98 @@ def onePhoto(cameraname, camera, weburl, camparam):
             timePriorPhoto1 = time.time()
         else:
             timePriorPhoto2 = time.time()
+        record = frameRecord(cameraname, frame, layer, trigger, started, capturefile)
+        if staging and ingest is not None:  # resized before it is written - the image is written once
+            ingest.add(record, capturefile, lambda record: writer.add(capturefile, framefile, record))
+        elif staging:
+            writer.add(capturefile, framefile, record)
+        else:
+            frameReady(record)
+        saveState()
+
+
+def frameRecord(cameraname, frame, layer, trigger, started, framefile):
+    captured = time.monotonic()
+    record = {'c': cameraname, 'n': frame, 'l': layer if isinstance(layer, int) else -1, 'z': -1,
+              't': round(time.time(), 3), 'm': round(captured, 3), 'tr': trigger,
+              'd': round(captured - started, 3), 'b': 0}
+    try:
+        record['b'] = os.path.getsize(framefile)
+    except OSError:
+        pass
+    if trigger != 'final':
+        record['z'] = zposition  # best effort - the capture is not held up for the printer
+    return record
+
+
+def refreshZ():
+    # SBC status (read for the layer) has the head height.  Otherwise it is fetched in the
+    # background while the frame is captured - at most one request at a time.
+    global zrefresh
+    if apiModel != 'rr_model' or (zrefresh is not None and zrefresh.is_alive()):
+        return
+    zrefresh = threading.Thread(target=fetchZ, daemon=True)
+    zrefresh.start()
+
+
+def fetchZ():
+    global zposition
+    _, _, zpos = getDuetPosition(apiModel)
+    if zpos != -1:
+        zposition = zpos
+
+
+def frameReady(record):
+    # Called once an image that was not staged is in the capture directory
+    if ingest is not None:
+        ingest.add(record, os.path.join(workingdir, record['c'] + '_' + str(record['n']).zfill(8) + '.jpeg'))
+    else:
+        frameStored(record)
+
+
+def frameStored(record):
+    # Called once the image is in its final form
+    retention.add(record['b'])
+    try:
+        manifest.append(record)
+    except OSError as e:
+        logger.debug('Could not record frame ' + str(record['n']) + ' ' + str(e))
+    if archive is not None:
+        archive.add(os.path.join(workingdir, record['c'] + '_' + str(record['n']).zfill(8) + '.jpeg'))
+        retention.add(record['b'])  # the image is stored in the zip as well
+    queueSegments(record['c'])
+    queueDecimation()
+
+
+def framesSettled():
+    # Waits until every captured image is in its final form in the capture directory
+    if ingest is not None:  # staged images go on to the writer
+        ingest.flush()
+    if writer is not None:
+        writer.flush()
+
+
+def ingestFrame(record, framefile):  # Run in the ingest pool
+    # Resizes and re-encodes the image (in -stage or the capture directory) to -ingestwidth and -ingestquality
+    name = record['c'] + '_' + str(record['n']).zfill(8)
+    resized = os.path.join(os.path.dirname(framefile), name + '_resized.jpg')  # not seen as a frame until it is renamed
+    cmd = ('ffmpeg' + ffmpegquiet + ' -y -i "' + framefile + '" -vf "scale=\'min(' + str(ingestwidth)
+           + ',iw)\':-2" -q:v ' + str(ingestquality) + ' "' + resized + '"' + debug)
+    if runsubprocess(cmd) is False or not os.path.isfile(resized):
+        storage.remove(resized)
+        return record
+    size = os.path.getsize(resized)
+    if size >= record['b'] > 0:  # Already small enough - keep the original
+        storage.remove(resized)
+        return record
+    if keeporiginal:
+        originals = os.path.join(workingdir, 'originals')
+        storage.makedirs(originals)
+        shutil.move(framefile, os.path.join(originals, name + '.jpeg'))  # -stage may be another filesystem
+        retention.add(record['b'])
+    os.replace(resized, framefile)
+    record['b'] = size
+    return record
 
 
 def oneInterval(cameraname, camera, weburl, camparam):
@@ -1053,12 +3264,12 @@ def oneInterval(cameraname, camera, weburl, camparam):
             # Layer changed, take a picture.
             checkForPause(zn)
             logger.info(cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' after layer change')
-            onePhoto(cameraname, camera, weburl, camparam)
+            onePhoto(cameraname, camera, weburl, camparam, 'layer', zn)
 
     elif ('pause' in detect) and (duetStatus == 'paused'):
         checkForPause(zn)
         logger.info(cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' at pause in print gcode')
-        onePhoto(cameraname, camera, weburl, camparam)
+        onePhoto(cameraname, camera, weburl, camparam, 'pause', zn)
 
     # update the layer counter
     if cameraname == 'Camera1':
@@ -1076,7 +3287,7 @@ def oneInterval(cameraname, camera, weburl, camparam):
         checkForPause(zn)
         logger.info(cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' after ' + str(
                 seconds) + ' seconds')
-        onePhoto(cameraname, camera, weburl, camparam)
+        onePhoto(cameraname, camera, weburl, camparam, 'seconds', zn)
 
 #############################################################################
 ##############  Duet API access Functions
@@ -1205,6 +3416,7 @@ def getDuetStatus(model):
 
 def getDuetLayer(model):
     # Used to get the status information from Duet
+    global zposition
     if model == 'rr_model':
         URL = ('http://' + duet + '/rr_model?key=job.layer')
         r = urlCall(URL, 3, False)
@@ -1226,6 +3438,10 @@ def getDuetLayer(model):
                 layer = j['job']['layer']
                 if layer is None:
                     layer = -1
+                try:
+                    zposition = j['move']['axes'][2]['machinePosition']  # saves asking again for each frame
+                except (KeyError, IndexError, TypeError):
+                    pass
                 return layer
             except:
                 pass
@@ -1281,14 +3497,29 @@ def sendDuetGcode(model, command):
     return
 
 
+def deleteFile(file):
+    result = storage.remove(file)
+    if result is False:
+        logger.info('!!!!! An error occurred trying to delete ' + file + ' !!!!!')
+    else:
+        jobindex.removed(file)
+    if file.endswith('.mp4'):  # The preview and poster belong to the video
+        for extra in [proxyName(file), posterName(file)]:
+            storage.remove(extra)
+    return result
+
 def makeVideo():  #  Adds and extra frame
     onePhoto('Camera1', camera1, weburl1, camparam1)
     if camera2 != '':
-        onePhoto('Camera2', camera1, weburl1, camparam1)
+        onePhoto('Camera2', camera2, weburl2, camparam2)
     createVideo(workingdir)
 
 def terminate():
     global httpListener, listener, nextactionthread, httpthread
+    if ingest is not None:  # staged images go on to the writer
+        ingest.flush()
+    if writer is not None:  # Images still in -stage
+        writer.close()
     cleanupFiles('terminate')
     # close the nextaction thread if necessary.  nextAction will have close the capturethread
     try:
@@ -1336,6 +3567,57 @@ class MyHandler(SimpleHTTPRequestHandler):
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
+    def _send_json(self, data):
+        content = json.dumps(data).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_zip(self, directory):
+        # The archive is written straight to the socket as it is made - nothing is stored on disk.
+        # Images and videos are already compressed so they are stored without compression.
+        if not os.path.isdir(directory):
+            self.send_error(404, 'Directory not found')
+            return
+        directory = os.path.normpath(directory)
+        name = os.path.basename(directory).replace(u'\u02f8', '-') + '.zip'
+        if archiveCurrent(directory):  # made during capture (-livezip)
+            self._send_archive(directory + '.zip', name)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/zip')
+        self.send_header('Content-Disposition', 'attachment; filename="' + name.encode('ascii', 'replace').decode() + '"')
+        self.end_headers()
+        try:
+            with zipfile.ZipFile(self.wfile, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for thisdir, _, files in os.walk(directory):
+                    for file in sorted(files):
+                        path = os.path.join(thisdir, file)
+                        if file.lower().endswith(('.jpeg', '.jpg', '.mp4', '.zip')):
+                            compression = zipfile.ZIP_STORED
+                        else:
+                            compression = zipfile.ZIP_DEFLATED
+                        archive.write(path, os.path.relpath(path, os.path.dirname(directory)), compression)
+            logger.info('Zip download of ' + name + ' completed')
+        except (OSError, ValueError) as e:  # e.g. the browser closed the connection
+            logger.info('Zip download of ' + name + ' stopped: ' + str(e))
+
+    def _send_archive(self, path, name):
+        try:
+            with open(path, 'rb') as f:
+                self.send_response(200)
+                self.send_header('Content-type', 'application/zip')
+                self.send_header('Content-Disposition', 'attachment; filename="' + name.encode('ascii', 'replace').decode() + '"')
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile, 1048576)
+            logger.info('Zip download of ' + name + ' completed')
+        except OSError as e:
+            logger.info('Zip download of ' + name + ' stopped: ' + str(e))
+
     def _refresh(self, message):
         content = f'<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd"><html><head><meta http-equiv="refresh" content="60"></head><body><h2>{message}</h2></body></html>'
         return content.encode("utf8")  # NOTE: must return a bytes object!
@@ -1429,6 +3711,21 @@ class MyHandler(SimpleHTTPRequestHandler):
         txt.append('</div>')
         snapshotbutton = ''.join(txt)
 
+        txt = []
+        job = sessionJob(workingdir) if workingdir_exists else sessionJob(baseworkingdir)
+        mergeable = job != '' and len(lineageSessions(job)) > 1
+        if mergeable:
+            disable = ''
+        else:
+            disable = 'disabled'
+        txt.append('<div class="inline">')
+        txt.append('<form action="http://' + referer + '">')
+        txt.append('<input type="hidden" name="command" value="merge" />')
+        txt.append('<input type="submit" value="Merge" ' + disable + ' style="background-color:green"/>')
+        txt.append('</form>')
+        txt.append('</div>')
+        mergebutton = ''.join(txt)
+
         txt = []
         value = 'restart'
         if value in allowed:
@@ -1515,12 +3812,14 @@ class MyHandler(SimpleHTTPRequestHandler):
             for button in allowed:
                     btn = btn + ' + ' + button + 'button'
 
+            if mergeable:
+                btn = btn + ' + mergebutton'
             btn = 'statusbutton' + btn + '+ filesbutton + infobutton + terminatebutton + fpsbutton + cssstyle'
             logger.debug(btn)
             buttons = eval(btn)
         else:
             buttons = statusbutton + startbutton + standbybutton + pausebutton + continuebutton
-            buttons = buttons + snapshotbutton + filesbutton + infobutton + restartbutton + terminatebutton + fpsbutton
+            buttons = buttons + snapshotbutton + mergebutton + filesbutton + infobutton + restartbutton + terminatebutton + fpsbutton
             buttons = buttons + cssstyle
 
         return buttons
@@ -1546,6 +3845,18 @@ class MyHandler(SimpleHTTPRequestHandler):
         txt.append('Duet Status:               =    ' + duetStatus + '<br>')
         txt.append('Images Captured:           =    ' + str(frame1) + '<br>')
         txt.append('Current Layer:             =    ' + thislayer)
+        for label, position in list(encodequeue.positions.values()):
+            txt.append('<br>' + label + ':  waiting for ffmpeg - position ' + str(position) + ' in the encode queue')
+        for line in progressText():
+            txt.append('<br>' + line)
+        for line in jobs.status():
+            txt.append('<br>' + html.escape(line))
+        if writer is not None:
+            txt.append('<br>' + html.escape(writer.status()))
+        if ingest is not None:
+            txt.append('<br>' + html.escape(ingest.status()))
+        for line in retention.status():
+            txt.append('<br>' + html.escape(line))
         txt.append('</h3>')
         status = ''.join(txt)
         return status
@@ -1580,6 +3891,14 @@ class MyHandler(SimpleHTTPRequestHandler):
 
         return info
 
+    def do_HEAD(self):
+        # Headers only - files are checked as for GET, anything else is a page
+        path = urlparse(self.path).path
+        if path.endswith('/') or path.startswith('/api/') or urlparse(self.path).query:
+            self._set_headers()
+            return
+        self.display_dir(self.path, head=True)
+
     def do_GET(self):
         global referer, refererip
         referer = self.headers['Host']  # Should always be there
@@ -1596,12 +3915,32 @@ class MyHandler(SimpleHTTPRequestHandler):
         if 'favicon.ico' in self.path:
             return
 
+        if urlparse(self.path).path == '/api/encode':
+            self._send_json(encodeProgress())
+            return
+
+        if urlparse(self.path).path == '/api/jobs':
+            self._send_json(jobs.list())
+            return
+
+        if urlparse(self.path).path == '/api/history':
+            self._send_json(jobindex.capturesets())
+            return
+
+        if urlparse(self.path).path == '/api/status':
+            self._send_json(statusData())
+            return
+
         query_components = parse_qs(urlparse(self.path).query)
         logger.debug(str(self.path))
 
         #  Files request gets trapped here
-        if (query_components and not query_components.get('command') and not query_components.get('delete')) or (
+        if (query_components and not query_components.get('command') and not query_components.get('delete')
+                and not query_components.get('zip')) or (
                 not query_components and self.path != '/'):
+            if not urlparse(self.path).path.endswith('/'):  # a file - the response has been sent
+                self.display_dir(self.path)
+                return
             selectMessage = self.display_dir(self.path)
 
         if query_components.get('delete'):
@@ -1614,33 +3953,20 @@ class MyHandler(SimpleHTTPRequestHandler):
 
             if win:
                 file = file.replace('/', '\\')
-                if os.path.isdir(file):
-                    cmd = 'rmdir /s /q "' + file + '"'
-                else:
-                    cmd = 'del /q "' + file + '"'
-            else:
-                cmd = 'rm -rf "' + file + '"'
 
-            if runsubprocess(cmd) is False:
-                logger.info('!!!!! An error occurred trying to delete ' + file + ' !!!!!')
-
-            selectMessage = self.display_dir(filepath)
-
-        if query_components.get('zip'):
-            file = query_components['zip'][0]
-            filepath, _ = os.path.split(file)
-            filepath = filepath + '/'
-            file = topdir + file
-            zipedfile = file + '.zip'
+            jobid, _ = jobs.submit('delete', file, deleteFile, (file,))
+            if jobs.wait(jobid, 2) in ['queued', 'running']:
+                selectMessage = '<h3>Delete is running in the background (job ' + str(jobid) + ')</h3>'
+                selectMessage = selectMessage + self.display_dir(filepath)
+            else:
+                selectMessage = self.display_dir(filepath)
 
+        if query_components.get('zip'):  # download
+            file = topdir + query_components['zip'][0]
             if win:
                 file = file.replace('/', '\\')
-                zipedfile = zipedfile.replace('/', '\\')
-
-            # threading.Thread(target=make_archive, args=(file, zipedfile,)).start()
-            result = make_archive(file, zipedfile)
-            selectMessage = '<h3>' + result + '<br></h3>' + self.display_dir(filepath)
-            # selectMessage = self.display_dir(filepath)
+            self._send_zip(file)
+            return
 
         if query_components.get('terminate'):  # This form is only called from the UI - see also command=terminate
             terminatetype = query_components['terminate'][0]
@@ -1764,6 +4090,20 @@ class MyHandler(SimpleHTTPRequestHandler):
 
                 threading.Thread(target=nextAction, args=(command,)).start()
 
+            elif command == 'merge':
+                txt = []
+                txt.append('<h3>')
+                txt.append('Attempting to merge the videos of every session of this job')
+                txt.append('</h3>')
+                txt.append('<div class="info-disp">')
+                txt.append('Videos from earlier sessions (e.g. before a restart) are joined without re-encoding.<br>')
+                txt.append('Only images not yet in a video are encoded.<br>')
+                txt.append('Check the files menu for the merged video<br><br>')
+                txt.append('</div>')
+                selectMessage = ''.join(txt)
+
+                threading.Thread(target=mergeVideos, args=()).start()
+
             elif command == 'terminate':  #only called explicitely - backward compatible
                     selectMessage = self.terminate_process('graceful')
 
@@ -1848,7 +4188,7 @@ class MyHandler(SimpleHTTPRequestHandler):
         return selectMessage
 
 
-    def display_dir(self, path):
+    def display_dir(self, path, head=False):
         path = path.split('?', 1)[0]
         path = path.split('#', 1)[0]
         # Don't forget explicit trailing slash when normalizing. Issue17324
@@ -1865,53 +4205,23 @@ class MyHandler(SimpleHTTPRequestHandler):
                                                   u'\u02f8')  # undoes raised colons that were replaced by encoding
             ctype = self.guess_type(requested_dir)
             logger.debug(str(ctype))
-
-            try:
-                f = open(requested_dir, 'rb')
-                fs = os.fstat(f.fileno())
-            except:
-                logger.info('Problem opening file: ' + requested_dir)
-
-            try:
-                self.send_response(200)
-                self.send_header("Content-type", ctype)
-                self.send_header("Content-Length", str(fs[6]))
-                self.end_headers()
-                self.copyfile(f, self.wfile)
-                f.close()
-            except ConnectionError:
-                logger.info('Connection reset - normal if displaying file')
-            except:
-                logger.info('Error sending file')
+            sendFile(self, requested_dir, ctype, logger, head)
 
         return ''
 
     def list_dir(self, path):  # Copied from super class
-        # Pass the directory tree and determine what can be done with each file / dir
-        jpegfile = '.jpeg'
+        # Determine what can be done with each file / dir
         deletablefiles = ['.mp4','.zip'] #Different to startDUetLapse3
-        jpegfolder = []
-        deletelist = []
-        for thisdir, subdirs, files in os.walk(topdir):
-            if not subdirs and not files:  # Directory is empty
-                deletelist.append(os.path.join(thisdir, ''))
-                if thisdir == topdir:
-                    txt = []
-                    txt.append('<h3>')
-                    txt.append('There are no files to display at this time<br><br>')
-                    txt.append('You likely need to start an instance of DuetLapse3 first')
-                    txt.append('</h3>')
-                    response = ''.join(txt)
-                    return response
-
-            for file in files:
-                if any(ext in file for ext in deletablefiles):
-                    deletelist.append(os.path.join(thisdir, file))
-
-                elif file.lower().endswith(jpegfile.lower()) and subdirs == []:  # if ANY jpeg in bottom level folder
-                    jpegfolder.append(os.path.join(thisdir, ''))
-                    deletelist.append(os.path.join(thisdir, ''))
-                    break  # Assume all files are jpeg
+        # Only this directory and its sub-directories are looked at - answered from the directory cache
+        if dircache.entries(topdir) == []:
+            txt = []
+            txt.append('<h3>')
+            txt.append('There are no files to display at this time<br><br>')
+            txt.append('You likely need to start an instance of DuetLapse3 first')
+            txt.append('</h3>')
+            response = ''.join(txt)
+            return response
+        jpegfolder, deletelist = dircache.classify(path, deletablefiles)
 
         try:
             displaypath = urllib.parse.unquote(path, errors='surrogatepass')
@@ -1920,9 +4230,8 @@ class MyHandler(SimpleHTTPRequestHandler):
 
         displaypath = html.escape(displaypath, quote=False)
         # Pass the direstory tree and determine what can be done with each file / dir - NOT USED
-        try:
-            list = os.listdir(path)
-        except OSError:
+        entries = dircache.entries(path)
+        if entries is None:
             txt = []
             txt.append('<h3>')
             txt.append('There are no files or directories named '+displaypath+'<br>')
@@ -1931,7 +4240,8 @@ class MyHandler(SimpleHTTPRequestHandler):
             response = ''.join(txt)
             return response
 
-        list.sort(key=lambda a: a.lower())
+        list = [name for name, _, _ in entries]  # sorted by the cache
+        kinds = {name: (isdir, islink) for name, isdir, islink in entries}
 
         subdir = path.replace(topdir, '') #path relative to topdir
         parentdir, _ = os.path.split(subdir) # Get rid of trailing information
@@ -1965,6 +4275,8 @@ class MyHandler(SimpleHTTPRequestHandler):
         for name in list:  #this loop is DuetLapse3 specific - different to startDuetLapse3
             if not name.startswith(pid) and not name.endswith('.jpeg'):
                 continue  # only display for this instance
+            if name.endswith('_proxy.mp4') or name.endswith('_poster.jpg'):
+                continue  # displayed with their video
 
             fullname = os.path.join(path, name)
             fullname = os.path.normpath(fullname) #no trailing slash will add in later if its a directory
@@ -1972,10 +4284,10 @@ class MyHandler(SimpleHTTPRequestHandler):
             # we do this after above assignment so that we don't have problems with slash direction between OS's
             # Note: a link to a directory displays with @ and folder  with /
             linkname = displayname = name
-            if os.path.islink(fullname):
+            if kinds[name][1]:
                 displayname = name + "@"
 
-            if os.path.isdir(fullname):
+            if kinds[name][0]:
                 if win:
                     displayname = name + "\\"
                     linkname = name + "\\"
@@ -1990,8 +4302,25 @@ class MyHandler(SimpleHTTPRequestHandler):
             displayname = displayname.replace(u'\u02f8', ':')  # make it look nice replace raised colons
 
             r.append('<tr>')  # start the row
-            r.append('<td><a href="%s">%s</a></td>' % (
-                    urllib.parse.quote(linkname, errors='surrogatepass'), html.escape(displayname, quote=False)))
+            if name.endswith('.mp4') and proxyName(name) in list:  # link to the small preview by default
+                previewname = (subdir + proxyName(name)).replace('\\', '/')
+                r.append('<td><a href="%s">%s</a>  <a href="%s">(full size)</a>' % (
+                        urllib.parse.quote(previewname, errors='surrogatepass'), html.escape(displayname, quote=False),
+                        urllib.parse.quote(linkname, errors='surrogatepass')))
+                if posterName(name) in list:
+                    postername = (subdir + posterName(name)).replace('\\', '/')
+                    r.append('<br><a href="%s"><img src="%s" height="90"></a>' % (
+                            urllib.parse.quote(previewname, errors='surrogatepass'),
+                            urllib.parse.quote(postername, errors='surrogatepass')))
+                r.append('</td>')
+            else:
+                r.append('<td><a href="%s">%s</a>' % (
+                        urllib.parse.quote(linkname, errors='surrogatepass'), html.escape(displayname, quote=False)))
+                if fullname in jpegfolder:  # frame counts and layers from the frame manifest
+                    summary = dircache.manifest(fullname).summary()
+                    if summary != '':
+                        r.append('<br><small>' + html.escape(summary) + '</small>')
+                r.append('</td>')
 
             deletebutton = zipbutton = vidbutton = ''
             if fullname in deletelist and not fullname in jpegfolder:  #Different to startDuetLapse3
@@ -2031,7 +4360,7 @@ def createHttpListener():
 ###################################
 
 def captureLoop():  # Run as a thread
-    global capturing, printState, duetStatus, nextactionthread
+    global capturing, printState, duetStatus, nextactionthread, polllatency, lastpoll
     capturing = True
     disconnected = 0
     printState = 'Not Capturing'
@@ -2039,7 +4368,10 @@ def captureLoop():  # Run as a thread
 
     while capturing:  # action can be changed by httpListener or SIGINT or CTL+C
 
+        polled = time.monotonic()
         duetStatus = getDuetStatus(apiModel)
+        polllatency = round(time.monotonic() - polled, 3)
+        lastpoll = time.time()
 
         if duetStatus == 'disconnected':  # provide some resiliency for temporary disconnects
             disconnected += 1
@@ -2151,6 +4483,8 @@ def nextAction(nextaction):  # can be run as a thread
             logger.info('Video creation was skipped')
         else:
             makeVideo()
+        with segmentlock:
+            discardSegments()  # Only needed while this instance is running
         terminate()
     elif nextaction == 'disconnected':
         terminate()
@@ -2236,11 +4570,21 @@ def startHttpListener(host, port):
 if __name__ == "__main__":  # Do not run anything below if the file is imported by another program
 
     # Globals.
-    global httpListener, win, pid, action, workingdir_exists
+    global httpListener, win, pid, action, workingdir_exists, segmentlock, segmentthreads, encodeprogress, encodeprogresslock
+    global decimatelock, lastdecimation
     httpListener = False  # Indicates if an integral httpListener should be started
     win = False  # Windows OS
     pid = ''  # pid for this instance - used for temp filenames
     workingdir_exists = False
+    segmentlock = threading.Lock()  # Protects the list of completed video segments
+    segmentthreads = {}  # Background segment encoder for each camera
+    encodeprogress = {}  # Progress of the latest encode for each camera
+    encodeprogresslock = threading.Lock()  # Held while encodeprogress is changed or copied
+    decimatelock = threading.Lock()  # Held while frames are decimated or being made into a video
+    lastdecimation = time.time()
+    polllatency = -1  # seconds taken by the latest status request to the printer
+    lastpoll = 0
+    lineagelock = threading.Lock()  # Serialises writes to the session lineage of a job
 
     setstartvalues()  # Default startup global values
 
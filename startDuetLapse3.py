@@ -15,16 +15,18 @@ import threading
 import subprocess
 import shlex
 import psutil
-from DuetLapse3 import whitelist, checkInstances, returncode
+from DuetLapse3 import whitelist, checkInstances, returncode, EncodeQueue, Storage, FrameManifest, JobRunner, JobIndex, DirectoryCache, archiveCurrent, sendFile, proxyName, posterName
 import socket
 import time
 import platform
 import requests
 import shutil
 import signal
+import json
+import concurrent.futures
 
 #  global startDuetLapse3Version
-startDuetLapse3Version = '3.5.0'
+startDuetLapse3Version = '3.6.0'
 
 
 class whitelistParser(argparse.ArgumentParser):
@@ -67,9 +69,11 @@ def init():
     parser.add_argument('-nolog', action='store_true', help='Do not create a log file')
     parser.add_argument('-verbose', action='store_true', help='Detailed Logging')
     parser.add_argument('-fps', type=int, nargs=1, default=[10], help='Frames-per-second for video. Default = 10')
+    parser.add_argument('-rebuild', type=str, nargs=1, choices=['none', 'missing', 'all'], default=['none'],
+                        help='Render videos for the frame directories under topdir then exit. Default = none')
     args = vars(parser.parse_args())
 
-    global host, port, defaultargs, topdir, maxffmpeg, nolog, verbose, debug, ffmpegquiet, fps
+    global host, port, defaultargs, topdir, maxffmpeg, nolog, verbose, debug, ffmpegquiet, fps, rebuild
 
     host = args['host'][0]
     port = args['port'][0]
@@ -79,6 +83,7 @@ def init():
     nolog = args['nolog']
     verbose = args['verbose']
     fps = str(args['fps'][0])
+    rebuild = args['rebuild'][0]
 
 
 
@@ -109,10 +114,13 @@ def init():
     logger.addHandler(c_handler)
     logfilename = ''
     if nolog is False:
+        logname = 'startDuetLapse3.log'
+        if rebuild != 'none':  # do not overwrite the log of a running http listener
+            logname = 'startDuetLapse3-rebuild.log'
         if topdir == '':
-            logfilename = os.path.realpath(__file__) + '/startDuetLapse3.log'
+            logfilename = os.path.realpath(__file__) + '/' + logname
         else:
-            logfilename = topdir + '/startDuetLapse3.log'
+            logfilename = topdir + '/' + logname
 
         if win:
             logfilename = logfilename.replace('/', '\\')
@@ -123,6 +131,23 @@ def init():
         logger.addHandler(f_handler)
         logger.info('Log file created at ' + logfilename)
 
+    # ffmpeg capacity is shared with every DuetLapse3 instance on this computer
+    global encodequeue
+    encodequeue = EncodeQueue(maxffmpeg, logger)
+
+    # File system operations report through the logger
+    global storage
+    storage = Storage(logger)
+
+    # Videos and deletes requested from the web UI.  One more worker than -maxffmpeg
+    # so that a delete is not held up by videos waiting for ffmpeg.
+    global jobs
+    jobs = JobRunner(maxffmpeg + 1, logger)
+
+    # Listings for the file browser
+    global dircache
+    dircache = DirectoryCache(logger)
+
 ###########################
 # make Web calls
 ###########################
@@ -161,7 +186,7 @@ from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 import urllib
 from urllib.parse import urlparse, parse_qs
 import html
-import pathlib
+import zipfile
 
 
 class MyHandler(SimpleHTTPRequestHandler):
@@ -185,6 +210,57 @@ class MyHandler(SimpleHTTPRequestHandler):
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
+    def _send_zip(self, directory):
+        # The archive is written straight to the socket as it is made - nothing is stored on disk.
+        # Images and videos are already compressed so they are stored without compression.
+        if not os.path.isdir(directory):
+            self.send_error(404, 'Directory not found')
+            return
+        directory = os.path.normpath(directory)
+        name = os.path.basename(directory).replace(u'\u02f8', '-') + '.zip'
+        if archiveCurrent(directory):  # made by DuetLapse3 during capture (-livezip)
+            self._send_archive(directory + '.zip', name)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/zip')
+        self.send_header('Content-Disposition', 'attachment; filename="' + name.encode('ascii', 'replace').decode() + '"')
+        self.end_headers()
+        try:
+            with zipfile.ZipFile(self.wfile, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for thisdir, _, files in os.walk(directory):
+                    for file in sorted(files):
+                        path = os.path.join(thisdir, file)
+                        if file.lower().endswith(('.jpeg', '.jpg', '.mp4', '.zip')):
+                            compression = zipfile.ZIP_STORED
+                        else:
+                            compression = zipfile.ZIP_DEFLATED
+                        archive.write(path, os.path.relpath(path, os.path.dirname(directory)), compression)
+            logger.info('Zip download of ' + name + ' completed')
+        except (OSError, ValueError) as e:  # e.g. the browser closed the connection
+            logger.info('Zip download of ' + name + ' stopped: ' + str(e))
+
+    def _send_json(self, data):
+        content = json.dumps(data).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_archive(self, path, name):
+        try:
+            with open(path, 'rb') as f:
+                self.send_response(200)
+                self.send_header('Content-type', 'application/zip')
+                self.send_header('Content-Disposition', 'attachment; filename="' + name.encode('ascii', 'replace').decode() + '"')
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile, 1048576)
+            logger.info('Zip download of ' + name + ' completed')
+        except OSError as e:
+            logger.info('Zip download of ' + name + ' stopped: ' + str(e))
+
     def _refresh(self, message):
         content = f'<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd"><html><head><meta http-equiv="refresh" content="60"></head><body><h2>{message}</h2></body></html>'
         return content.encode("utf8")  # NOTE: must return a bytes object!
@@ -214,6 +290,22 @@ class MyHandler(SimpleHTTPRequestHandler):
         txt.append('<h4>')
         txt.append('Running instances of DuetLapse3 are:<br>' + runninginstances)
         txt.append('</h4>')
+        running, waiting = encodequeue.waiting()
+        if running or waiting:
+            txt.append('<h4>')
+            txt.append('ffmpeg encodes on this computer:<br>')
+            for label in running:
+                txt.append('Running:  ' + html.escape(label) + '<br>')
+            for position, label in enumerate(waiting, 1):
+                txt.append('Waiting (' + str(position) + '):  ' + html.escape(label) + '<br>')
+            txt.append('</h4>')
+        joblines = jobs.status()
+        if joblines:
+            txt.append('<h4>')
+            txt.append('Background jobs:<br>')
+            for line in joblines:
+                txt.append(html.escape(line) + '<br>')
+            txt.append('</h4>')
         status = ''.join(txt)
 
         txt = []
@@ -262,6 +354,15 @@ class MyHandler(SimpleHTTPRequestHandler):
         txt.append('</div>')
         filesbutton = ''.join(txt)
 
+        txt = []
+        txt.append('<div class="inline">')
+        txt.append('<form action="http://' + referer + '">')
+        txt.append('<input type="hidden" name="history" value="all" />')
+        txt.append('<input type="submit" value="History" style="background-color:green"/>')
+        txt.append('</form>')
+        txt.append('</div>')
+        historybutton = ''.join(txt)
+
         txt = []
         txt.append('<style type="text/css">')
         txt.append('{')
@@ -293,10 +394,18 @@ class MyHandler(SimpleHTTPRequestHandler):
         txt.append('} </style>')
         cssstyle = ''.join(txt)
 
-        buttons = statusbutton + startbutton + terminatebutton + filesbutton + shutdownbutton + cssstyle
+        buttons = statusbutton + startbutton + terminatebutton + filesbutton + historybutton + shutdownbutton + cssstyle
 
         return header, status, buttons
 
+    def do_HEAD(self):
+        # Headers only - files are checked as for GET, anything else is a page
+        path = urlparse(self.path).path
+        if path.endswith('/') or path.startswith('/api/') or urlparse(self.path).query:
+            self._set_headers()
+            return
+        self.display_dir(self.path, head=True)
+
     def do_GET(self):
         options = 'status, start, terminate'
         global referer, refererip, selectMessage, refreshing, lastdir
@@ -313,6 +422,14 @@ class MyHandler(SimpleHTTPRequestHandler):
         if ('favicon.ico' in self.path):
             return
 
+        if urlparse(self.path).path == '/api/jobs':
+            self._send_json(jobs.list())
+            return
+
+        if urlparse(self.path).path == '/api/history':
+            self._send_json(jobindex.within(topdir))
+            return
+
         query_components = parse_qs(urlparse(self.path).query)
 
         if not query_components and self.path != '/':
@@ -333,8 +450,14 @@ class MyHandler(SimpleHTTPRequestHandler):
             lastdir, _ = os.path.split(thisdir)  # only interested in the path portion cuz could be file display request
             if not lastdir.endswith('/'): #force it to be recognized as a dir
                 lastdir = lastdir +'/'
+            if not urlparse(thisdir).path.endswith('/'):  # a file - the response has been sent
+                self.display_dir(thisdir)
+                return
             selectMessage = self.display_dir(thisdir)
 
+        if (query_components.get('history')):
+            selectMessage = self.job_history()
+
         if (query_components.get('delete')):
             file = query_components['delete'][0]
             filepath, _ = os.path.split(file)
@@ -345,31 +468,20 @@ class MyHandler(SimpleHTTPRequestHandler):
 
             if win:
                 file = file.replace('/', '\\')
-                if os.path.isdir(file):
-                    cmd = 'rmdir /s /q "' + file + '"'
-                else:
-                    cmd = 'del /q "' + file + '"'
-            else:
-                cmd = 'rm -rf "' + file + '"'
-
-            if runsubprocess(cmd) is False:
-                logger.info('Could not delete ' + str(file))
 
-            selectMessage = self.display_dir(filepath)
-
-        if (query_components.get('zip')):
-            file = query_components['zip'][0]
-            filepath, _ = os.path.split(file)
-            filepath = filepath + '/'
-            file = topdir + file
-            zipedfile = file + '.zip'
+            jobid, _ = jobs.submit('delete', file, deleteFile, (file,))
+            if jobs.wait(jobid, 2) in ['queued', 'running']:
+                selectMessage = '<h3>Delete is running in the background (job ' + str(jobid) + ')</h3>'
+                selectMessage = selectMessage + self.display_dir(filepath)
+            else:
+                selectMessage = self.display_dir(filepath)
 
+        if (query_components.get('zip')):  # download
+            file = topdir + query_components['zip'][0]
             if win:
                 file = file.replace('/', '\\')
-                zipedfile = zipedfile.replace('/', '\\')
-
-            result = make_archive(file, zipedfile)
-            selectMessage = '<h3>' + result + '<br></h3>' + self.display_dir(filepath)
+            self._send_zip(file)
+            return
 
         if (query_components.get('video')):
             global fps
@@ -391,7 +503,11 @@ class MyHandler(SimpleHTTPRequestHandler):
             if win:
                 file = file.replace('/', '\\')
 
-            result = createVideo(file)
+            jobid, new = jobs.submit('video', file, videoJob, (file,), lambda: videoProgress(file))
+            if new:
+                result = 'Video started in the background (job ' + str(jobid) + ').  Progress is shown on the status page'
+            else:
+                result = 'This video is already being made (job ' + str(jobid) + ')'
 
             selectMessage = '<h3>'+result+'<br></h3>'+self.display_dir(filepath)
 
@@ -405,7 +521,7 @@ class MyHandler(SimpleHTTPRequestHandler):
                 if selectMessage == None:
                     selectMessage = refreshing
                 self._set_headers()
-                self.wfile.write(self._refresh(status + buttons + selectMessage))
+                self.wfile.write(self._refresh(status + self.instance_states() + buttons + selectMessage))
                 selectMessage = refreshing
                 return
 
@@ -618,7 +734,7 @@ class MyHandler(SimpleHTTPRequestHandler):
         selectMessage = ''.join(txt)
         return selectMessage
 
-    def display_dir(self, path):
+    def display_dir(self, path, head=False):
         path = path.split('?', 1)[0]  #get rid of any query arguments
         path = path.split('#', 1)[0]
         # Don't forget explicit trailing slash when normalizing. Issue17324
@@ -635,54 +751,85 @@ class MyHandler(SimpleHTTPRequestHandler):
                                                   u'\u02f8')  # redoes raised colons that were replaced by encoded
 
             ctype = self.guess_type(requested_dir)
-
-            try:
-                f = open(requested_dir, 'rb')
-                fs = os.fstat(f.fileno())
-            except:
-                logger.info('Problem opening file: ' + requested_dir)
-
-            try:
-                self.send_response(200)
-                self.send_header("Content-type", ctype)
-                self.send_header("Content-Length", str(fs[6]))
-                self.end_headers()
-                self.copyfile(f, self.wfile)
-                f.close()
-            except ConnectionError:
-                logger.info('Connection reset - normal if displaying file')
-            except:
-                logger.info('Error sending file')
+            sendFile(self, requested_dir, ctype, logger, head)
 
         return
 
+    def instance_states(self):
+        # One line for each DuetLapse3 instance with a port - only built for the status page
+        ports = [(instancepid, instanceport) for instancepid, instanceport in pidlist if instanceport != 0]
+        if not ports:
+            return ''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            states = list(pool.map(lambda instance: instanceStatus(refererip, instance[1]), ports))
+        lines = []
+        for (instancepid, _), state in zip(ports, states):
+            if not isinstance(state, dict):
+                continue
+            line = 'Process id:  ' + str(instancepid) + ' -- ' + str(state.get('action')) + ', ' + str(state.get('printState'))
+            line = line + ', printer ' + str(state.get('duetStatus'))
+            cameras = state.get('cameras') if isinstance(state.get('cameras'), dict) else {}
+            for cameraname, camera in sorted(cameras.items()):
+                line = line + ', ' + cameraname + ' ' + str(camera.get('frames')) + ' images'
+            if isinstance(state.get('layer'), int) and state['layer'] >= 0:
+                line = line + ', layer ' + str(state['layer'])
+            lines.append(html.escape(line))
+        if not lines:
+            return ''
+        return '<h4>Instance state:<br>' + '<br>'.join(lines) + '</h4>'
+
+    def job_history(self):
+        # Capture sets from the job index - newest first
+        capturesets = jobindex.within(topdir)
+        if not capturesets:
+            return '<h3>There is no job history at this time</h3>'
+        r = []
+        r.append('<style>table {font-family: arial, sans-serif;border-collapse: collapse;}')
+        r.append('td, th {border: none; text-align: left;padding: 0px 8px 0px 0px;}')
+        r.append('tr:nth-child(even) {background-color: #dddddd;}</style>')
+        r.append('<table>')
+        r.append('<tr><th>Job</th><th>Printer</th><th>Started</th><th>Ended</th><th>Frames</th><th>MB</th><th>Videos</th></tr>')
+        for captureset in reversed(capturesets):
+            job = captureset.get('job') or captureset['d']
+            frames = ', '.join(cameraname + ' ' + str(count) for cameraname, count in sorted(captureset.get('frames', {}).items()))
+            if captureset.get('gone'):
+                frames = frames + ' (deleted)'
+            videos = []
+            for video, details in sorted(captureset['v'].items()):
+                link = os.path.relpath(os.path.join(jobindex.basedir, os.path.normpath(video)), topdir).replace('\\', '/')
+                text = '<a href="%s">%s</a>' % (urllib.parse.quote('/' + link, errors='surrogatepass'),
+                                                html.escape(os.path.basename(video).replace(u'\u02f8', ':')))
+                text = text + ' ' + str(round(details.get('b', 0) / 1048576, 1)) + ' MB'
+                if details.get('s'):
+                    text = text + ' ' + str(details['s']) + ' sec'
+                videos.append(text)
+            r.append('<tr>')
+            r.append('<td>' + html.escape(job.replace(u'\u02f8', ':')) + '</td>')
+            r.append('<td>' + html.escape(str(captureset.get('printer', ''))) + '</td>')
+            for field in ['start', 'end']:
+                when = captureset.get(field)
+                r.append('<td>' + (time.strftime('%Y-%m-%d %H:%M', time.localtime(when)) if when else '') + '</td>')
+            r.append('<td>' + html.escape(frames) + '</td>')
+            r.append('<td>' + (str(captureset['bytes'] // 1048576) if 'bytes' in captureset else '') + '</td>')
+            r.append('<td>' + '<br>'.join(videos) + '</td>')
+            r.append('</tr>')
+        r.append('</table>')
+        return ''.join(r)
+
     def list_dir(self, path):  # Copied from super class
         global lastdir
-        # Pass the direstory tree and determine what can be done with each file / dir
-        jpegfile = '.jpeg'
+        # Determine what can be done with each file / dir
         deletablefiles = ['.mp4', '.log', '.zip']
-        jpegfolder = []
-        deletelist = []
-        for thisdir, subdirs, files in os.walk(topdir):
-            if not subdirs and not files:  # Directory is empty
-                deletelist.append(os.path.join(thisdir, ''))
-                if thisdir == topdir:
-                    txt = []
-                    txt.append('<h3>')
-                    txt.append('There are no files to display at this time<br>')
-                    txt.append('You likely need to start an instance of DuetLapse3 first')
-                    txt.append('</h3>')
-                    response = ''.join(txt)
-                    return response
-
-            for file in files:
-                if any (ext in file for ext in deletablefiles):
-                    deletelist.append(os.path.join(thisdir, file))
-
-                elif file.lower().endswith(jpegfile.lower()) and subdirs == []:  # if ANY jpeg in bottom level folder
-                    jpegfolder.append(os.path.join(thisdir, ''))
-                    deletelist.append(os.path.join(thisdir, ''))
-                    break  # Assume all files are jpeg
+        # Only this directory and its sub-directories are looked at - answered from the directory cache
+        if dircache.entries(topdir) == []:
+            txt = []
+            txt.append('<h3>')
+            txt.append('There are no files to display at this time<br>')
+            txt.append('You likely need to start an instance of DuetLapse3 first')
+            txt.append('</h3>')
+            response = ''.join(txt)
+            return response
+        jpegfolder, deletelist = dircache.classify(path, deletablefiles)
 
         try:
             displaypath = urllib.parse.unquote(path, errors='surrogatepass')
@@ -691,9 +838,8 @@ class MyHandler(SimpleHTTPRequestHandler):
 
         displaypath = html.escape(displaypath, quote=False)
 
-        try:
-            list = os.listdir(path)
-        except OSError:
+        entries = dircache.entries(path)
+        if entries is None:
             txt = []
             txt.append('<h3>')
             txt.append('There are no files or directories named '+displaypath+'<br>')
@@ -702,7 +848,8 @@ class MyHandler(SimpleHTTPRequestHandler):
             response = ''.join(txt)
             return response
 
-        list.sort(key=lambda a: a.lower())
+        list = [name for name, _, _ in entries]  # sorted by the cache
+        kinds = {name: (isdir, islink) for name, isdir, islink in entries}
 
         subdir = path.replace(topdir, '') #path relative to topdir
         parentdir, _ = os.path.split(subdir) # Get rid of trailing information
@@ -736,16 +883,18 @@ class MyHandler(SimpleHTTPRequestHandler):
             r.append('</tr>')  # end the row
 
         for name in list:
+            if name.endswith('_proxy.mp4') or name.endswith('_poster.jpg'):
+                continue  # displayed with their video
             fullname = os.path.join(path, name)
             fullname = os.path.normpath(fullname) #no trailing slash will add in later if its a directory
             action_name = fullname.replace(topdir, '')  # used to force delete and zip and video to be relative to topdir
             # we do this after above assignment so that we don't have problems with slash direction between OS's
             # Note: a link to a directory displays with @ and folder  with /
             linkname = displayname = name
-            if os.path.islink(fullname):
+            if kinds[name][1]:
                 displayname = name + "@"
 
-            if os.path.isdir(fullname):
+            if kinds[name][0]:
                 if win:
                     displayname = name + "\\"
                     linkname = name + "\\"
@@ -760,8 +909,25 @@ class MyHandler(SimpleHTTPRequestHandler):
             displayname = displayname.replace(u'\u02f8', ':')  # make it look nice replace raised colons
 
             r.append('<tr>')  # start the row
-            r.append('<td><a href="%s">%s</a></td>' % (
-                    urllib.parse.quote(linkname, errors='surrogatepass'), html.escape(displayname, quote=False)))
+            if name.endswith('.mp4') and proxyName(name) in list:  # link to the small preview by default
+                previewname = (subdir + proxyName(name)).replace('\\', '/')
+                r.append('<td><a href="%s">%s</a>  <a href="%s">(full size)</a>' % (
+                        urllib.parse.quote(previewname, errors='surrogatepass'), html.escape(displayname, quote=False),
+                        urllib.parse.quote(linkname, errors='surrogatepass')))
+                if posterName(name) in list:
+                    postername = (subdir + posterName(name)).replace('\\', '/')
+                    r.append('<br><a href="%s"><img src="%s" height="90"></a>' % (
+                            urllib.parse.quote(previewname, errors='surrogatepass'),
+                            urllib.parse.quote(postername, errors='surrogatepass')))
+                r.append('</td>')
+            else:
+                r.append('<td><a href="%s">%s</a>' % (
+                        urllib.parse.quote(linkname, errors='surrogatepass'), html.escape(displayname, quote=False)))
+                if fullname in jpegfolder:  # frame counts and layers from the frame manifest
+                    summary = dircache.manifest(fullname).summary()
+                    if summary != '':
+                        r.append('<br><small>' + html.escape(summary) + '</small>')
+                r.append('</td>')
             actionable = True
             for pidstart in pidlist:  # can only delete for non-running instances
                 if displayname.startswith(str(pidstart[0])):
@@ -820,105 +986,275 @@ class MyHandler(SimpleHTTPRequestHandler):
 #  ---------------------
 
 
-def make_archive(source, destination):
-    base = os.path.basename(destination)
-    format = pathlib.Path(destination).suffix
-    name = destination.replace(format,'')
-    format = format.replace('.','')
-    archive_from = os.path.dirname(source)
-    archive_to = os.path.basename(source.strip(os.sep))
-    try:
-        shutil.make_archive(name, format, archive_from, archive_to)
-        shutil.move('%s.%s' % (name, format), destination)
-        msg = ('Zip processing completed')
-    except Exception as msg1:
-        msg = 'Error: There was a problem creating the zip file --'
-        msg = msg + str(msg1)
-    return msg
+def deleteFile(file):
+    result = storage.remove(file)
+    if result is False:
+        logger.info('Could not delete ' + str(file))
+    else:
+        jobindex.removed(file)
+    if file.endswith('.mp4'):  # The preview and poster belong to the video
+        for extra in [proxyName(file), posterName(file)]:
+            storage.remove(extra)
+    return result
+
+
+def videoProgress(directory):
+    # Progress of a video job from its place in the encode queue
+    name = os.path.basename(directory)
+    progress = []
+    for label, position in list(encodequeue.positions.values()):
+        if name in label:
+            progress.append(label.rsplit(' ', 1)[-1] + ' waiting for ffmpeg (position ' + str(position) + ')')
+    if not progress:
+        return 'encoding'
+    return ', '.join(progress)
+
+
+def videoFailed(results):
+    # No camera made a video - a camera without enough frames does not fail the others
+    return not any(ok for _, ok, _ in results)
+
+
+def videoMessage(results):
+    return '<br>'.join(msg for _, _, msg in results)
+
+
+def videoJob(directory):
+    # The job fails with the messages as its result if no video was made
+    results = createVideo(directory)
+    if videoFailed(results):
+        raise RuntimeError(videoMessage(results))
+    return videoMessage(results)
+
 
 def createVideo(directory):
-    # loop through directory count # files and detect if Camera1 / Camera2
-    msg = 'Create Video'
-    logger.info(msg)
-    try:  #  Check to make sure we can create the video at the required destination
-        list = os.listdir(directory)
-    except OSError:
+    # Returns [(cameraname, True if the video was made, message)] - cameraname is '' for the directory
+    logger.info('Create Video')
+    if not os.path.isdir(directory):  #  Check to make sure we can create the video at the required destination
         msg = 'Error: No permission or directory not found'
         logger.info(msg)
-        return msg
-
-    cam1 = False
-    cam2 = False
-    frame = 0
-    Cameras = []
-    for name in list:
-        if not cam1:
-            if 'Camera1' in name:
-                cam1 = True
-                Cameras.append('Camera1')
-        elif not cam2:
-            if 'camera2' in name:
-                cam2 = True
-                Cameras.append('Camera2')
-        frame += 1
-
-    for cameraname in Cameras:
-        if frame < int(fps):
-            msg = 'Error: ' + cameraname + ': Cannot create video of less than 1 second: ' + fps + ' frames are required.'
-            logger.info(msg)
-            return msg
-
-        logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video')
-        if 250 < frame:
-            logger.info("This can take a while...")
-
-        timestamp = time.strftime('%a-%H-%M', time.localtime())
-
-        fn = ' "' + directory + '_' + cameraname + '_' + timestamp + '.mp4"'
+        return [('', False, msg)]
 
-        if win:
-            cmd = 'ffmpeg' + ffmpegquiet + ' -r ' + fps + ' -i "' + directory + '\\' + cameraname + '_%08d.jpeg" -vcodec libx264 -y ' + fn + debug
-        else:
-            cmd = 'ffmpeg' + ffmpegquiet + ' -r ' + fps + ' -i "' + directory + '/' + cameraname + '_%08d.jpeg" -vcodec libx264 -y ' + fn + debug
-
-        #  Wait for up to minutes for ffmpeg capacity to  become available
-        #  If still not available - try anyway
-        minutes = 5
-        increment = 15  #  seconds
-        loop = 0
-        while loop < minutes*60:
-            if ffmpeg_available():
-                break
-            else:
-                time.sleep(increment)  # wait a while before trying again
-                loop += increment
-                logger.debug('Have waited ' + str(loop) + ' seconds for ffmpeg capacity')
+    frames = {}  # frame numbers from the frame manifest (or the directory for older captures)
+    for cameraname, records in FrameManifest(directory).frames().items():
+        frames[cameraname] = sorted(records)
+
+    Cameras = sorted(frames)
+    if not Cameras:
+        msg = 'Error: There are no images to make into a video'
+        logger.info(msg)
+        return [('', False, msg)]
+
+    # Each camera is encoded concurrently - encodequeue still limits the number of ffmpeg instances
+    workers = max(1, min(len(Cameras), maxffmpeg))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(cameraVideo, directory, cameraname, frames[cameraname]) for cameraname in Cameras]
+        return [future.result() for future in futures]
+
+
+def frameInput(directory, cameraname, numbers):
+    # ffmpeg input for the frame numbers.  Frames numbered 1 to n use the image pattern.
+    # Otherwise (e.g. after -decimate in DuetLapse3) a concat list names each frame because
+    # the image pattern stops at the first missing number.
+    if numbers == list(range(1, len(numbers) + 1)):
+        return ' -r ' + fps + ' -i "' + os.path.join(directory, cameraname + '_%08d.jpeg') + '"'
+
+    listfile = os.path.join(directory, cameraname + '_frames.txt')
+    duration = str(1 / float(fps))
+    with open(listfile, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for number in numbers:
+            f.write('file ' + cameraname + '_' + str(number).zfill(8) + '.jpeg\n')
+            f.write('duration ' + duration + '\n')  # the last file too - repeating it would add a frame
+    return ' -f concat -safe 0 -i "' + listfile + '" -r ' + fps
+
+
+def cameraVideo(directory, cameraname, numbers):
+    # Returns (cameraname, True if the video was made, message)
+    frame = len(numbers)
+    if frame < int(fps):
+        msg = 'Error: ' + cameraname + ': Cannot create video of less than 1 second: ' + fps + ' frames are required.'
+        logger.info(msg)
+        return cameraname, False, msg
+
+    logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video')
+    if 250 < frame:
+        logger.info("This can take a while...")
+
+    timestamp = time.strftime('%a-%H-%M', time.localtime())
 
+    videofile = directory + '_' + cameraname + '_' + timestamp + '.mp4'
+    fn = ' "' + videofile + '"'
+    # Written under a temporary name so an interrupted encode never looks like a finished video
+    partfile = videofile + '.part'
 
-        if runsubprocess(cmd) is False:
-            msg = ('!!!!!!!!!!!  There was a problem creating the video for '+cameraname+' !!!!!!!!!!!!!!!')
-            logger.info(msg)
+    cmd = 'ffmpeg' + ffmpegquiet + frameInput(directory, cameraname, numbers) + ' -vcodec libx264 -f mp4 -y "' + partfile + '"' + debug
+
+    encodestart = time.time()
+    with encodequeue.slot('startDuetLapse3 ' + os.path.basename(directory) + ' ' + cameraname):
+        result = runsubprocess(cmd)
+
+    storage.remove(os.path.join(directory, cameraname + '_frames.txt'))
+    try:
+        if result is False:
+            os.remove(partfile)
         else:
-            logger.info('Video processing completed for ' + cameraname)
-            logger.info('Video is in file ' + fn)
-            msg = 'Video(s) successfully created'
+            os.replace(partfile, videofile)
+    except OSError as e:
+        logger.debug(str(e))
+        if not os.path.isfile(videofile):
+            result = False
+
+    if result is False:
+        msg = ('!!!!!!!!!!!  There was a problem creating the video for '+cameraname+' !!!!!!!!!!!!!!!')
+        logger.info(msg)
+    else:
+        logger.info('Video processing completed for ' + cameraname)
+        logger.info('Video is in file ' + fn)
+        msg = cameraname + ': Video successfully created'
+        jobindex.video(directory, videofile, time.time() - encodestart)
 
-    return msg
+    return cameraname, result is not False, msg
 
 
-def ffmpeg_available():
-    count = 0
-    max_count = maxffmpeg  # Default is 2
-    for p in psutil.process_iter():
-        if 'ffmpeg' in p.name():  # Check to see if it's running
-            count += 1
-        if count >= max_count:
-            logger.info('Waiting for ffmpeg to become available')
+###########################
+# Batch rebuild of videos
+###########################
+
+def videoCurrent(directory, cameras, newest):
+    # True if every camera already has a video newer than its newest frame
+    parent, name = os.path.split(directory)
+    try:
+        list = os.listdir(parent)
+    except OSError:
+        return False
+    for cameraname in cameras:
+        current = False
+        for video in list:
+            if not video.endswith('.mp4') or video.endswith('_proxy.mp4'):
+                continue
+            if not (video.startswith(name + '_' + cameraname + '_') or video.startswith(name + '_Composite_')):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(parent, video)) >= newest[cameraname]:
+                    current = True
+                    break
+            except OSError:
+                pass
+        if not current:
             return False
-    logger.info('There are ' + str(count) + ' instances of ffmpeg running')
     return True
 
 
+def rebuildList():
+    # Frame directories under topdir that need a video - skipping those of running instances
+    _, running = getRunningInstances(thisinstance, '')
+    running = [str(pid[0]) for pid in running]
+    pending = []
+    skipped = 0
+    for captureset in jobindex.within(topdir):  # reconciled with the tree at startup
+        thisdir = os.path.join(jobindex.basedir, os.path.normpath(captureset['d']))
+        if captureset.get('gone') or not os.path.isdir(thisdir):
+            continue
+        newest = {}
+        frames = 0
+        for cameraname, records in FrameManifest(thisdir).frames().items():
+            frames += len(records)
+            for number, record in records.items():
+                if 't' in record:  # capture time from the manifest saves a stat of every frame
+                    newest[cameraname] = max(newest.get(cameraname, 0), record['t'])
+                    continue
+                try:
+                    framefile = os.path.join(thisdir, cameraname + '_' + str(number).zfill(8) + '.jpeg')
+                    newest[cameraname] = max(newest.get(cameraname, 0), os.path.getmtime(framefile))
+                except OSError:
+                    pass
+        if frames == 0:
+            continue
+        if os.path.basename(thisdir).split('_', 1)[0] in running:
+            logger.info('In use - skipping ' + thisdir)
+            skipped += 1
+            continue
+        if rebuild == 'missing' and videoCurrent(thisdir, sorted(newest), newest):
+            logger.debug('Up to date - skipping ' + thisdir)
+            skipped += 1
+            continue
+        pending.append((thisdir, frames))
+    return pending, skipped
+
+
+def rebuildInit(settings):
+    # Runs in each worker process.  Worker processes do not inherit globals on Windows.
+    global fps, ffmpegquiet, debug, win, maxffmpeg, topdir, logger, encodequeue, jobindex, storage
+    fps, ffmpegquiet, debug, win, maxffmpeg, topdir, indexdir = settings
+    import logging
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        c_handler = logging.StreamHandler()
+        c_handler.setFormatter(logging.Formatter(' %(message)s'))
+        logger.addHandler(c_handler)
+    encodequeue = EncodeQueue(maxffmpeg, logger)
+    jobindex = JobIndex(indexdir, logger)
+    storage = Storage(logger)
+
+
+def rebuildDirectory(directory):
+    start = time.time()
+    failed = videoFailed(createVideo(directory))
+    return directory, time.time() - start, failed
+
+
+def rebuildVideos():
+    # Re-render every frame directory under topdir with a bounded pool of worker processes.
+    # Finished directories have a video newer than their frames so an interrupted run can simply be repeated.
+    logger.info('Scanning ' + topdir + ' for frame directories')
+    pending, skipped = rebuildList()
+    logger.info(str(len(pending)) + ' directories to render, ' + str(skipped) + ' skipped')
+    if not pending:
+        return 0
+
+    workers = max(1, maxffmpeg)
+    done = frames = failed = 0
+    start = time.time()
+    settings = (fps, ffmpegquiet, debug, win, maxffmpeg, topdir, jobindex.basedir)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=rebuildInit, initargs=(settings,))
+    try:
+        futures = {pool.submit(rebuildDirectory, directory): count for directory, count in pending}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                directory, seconds, error = future.result()
+            except Exception as e:
+                logger.info('Exception: ' + str(e))
+                failed += 1
+                continue
+            if error:
+                failed += 1
+            else:
+                done += 1
+                frames += futures[future]
+            logger.info('[' + str(done + failed) + '/' + str(len(pending)) + '] ' + directory + ' in ' + str(round(seconds, 1)) + ' sec')
+        pool.shutdown()
+    except KeyboardInterrupt:
+        logger.info('!!!!! Interrupted - run again to continue where this run stopped !!!!!')
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    elapsed = max(time.time() - start, 0.001)
+    logger.info('')
+    logger.info('###############  Rebuild summary  ###############')
+    logger.info('# Directories rendered  = ' + str(done))
+    logger.info('# Directories failed    = ' + str(failed))
+    logger.info('# Directories skipped   = ' + str(skipped))
+    logger.info('# Frames encoded        = ' + str(frames))
+    logger.info('# Elapsed time          = ' + str(round(elapsed, 1)) + ' sec')
+    logger.info('# Throughput            = ' + str(round(frames / elapsed, 1)) + ' frames/sec, '
+                + str(round(done * 60 / elapsed, 2)) + ' directories/min')
+    logger.info('#################################################')
+    return 1 if failed else 0
+
+
 def createHttpListener():
     global listener
     listener = ThreadingHTTPServer((host, port), MyHandler)
@@ -961,6 +1297,23 @@ def getThisInstance(thisinstancepid):
     return thisrunning
 
 
+def instanceStatus(host, port):
+    # State of a DuetLapse3 instance from its /api/status - None if it does not answer.
+    # Answers are reused for a few seconds so that refreshes do not query every instance again.
+    cached = instancestates.get(port)
+    if cached is not None and time.time() - cached[0] < 5:
+        return cached[1]
+    state = None
+    try:
+        r = requests.get('http://' + host + ':' + str(port) + '/api/status', timeout=1)
+        if r.ok:
+            state = r.json()
+    except (requests.RequestException, ValueError):
+        pass
+    instancestates[port] = (time.time(), state)
+    return state
+
+
 def getRunningInstances(thisinstance, refererip):
     running = ''
     pidlist = []
@@ -1051,14 +1404,16 @@ Main Program
 if __name__ == "__main__":
 
     global thisinstance, thisinstancepid, topdir
-    global refreshing, selectMessage, lastdir
+    global refreshing, selectMessage, lastdir, instancestates
+    instancestates = {}  # port : (time, /api/status of the DuetLapse3 instance)
 
     getOperatingSystem()  # some commands are os specific
     thisinstance = os.path.basename(__file__)
 
     if not win:
         thisinstance = './' + thisinstance
-    _ = checkInstances(thisinstance, 'single')  # There can only be one instance running
+    if '-rebuild' not in sys.argv:  # a batch rebuild can run alongside the http listener
+        _ = checkInstances(thisinstance, 'single')  # There can only be one instance running
     thisinstancepid = os.getpid()
     init()
 
@@ -1071,6 +1426,15 @@ if __name__ == "__main__":
         topdir = topdir.replace('\\', '/')
     topdir = os.path.normpath(topdir)  # Normalise the dir - no trailing slash
 
+    # History of the capture sets under topdir - recorded by DuetLapse3 in the index of its basedir
+    jobindex = JobIndex.find(topdir, logger)
+    logger.info('Reconciling the job index ' + jobindex.path)
+    jobindex.reconcile(topdir)  # capture sets from before there was an index or from older versions
+
+    if rebuild != 'none':
+        signal.signal(signal.SIGINT, signal.default_int_handler)  # no http listener or instances to stop
+        sys.exit(rebuildVideos())
+
     if port != 0:
         try:
             sock = socket.socket()